@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db.models import Prefetch
 from simple_history.admin import SimpleHistoryAdmin
 from .models import *
 from .forms import TerritoryForm
@@ -9,10 +10,29 @@ from .forms import TerritoryForm
 class TerritoryAdmin(SimpleHistoryAdmin, admin.ModelAdmin):
     form = TerritoryForm
     include = "__all__"
+    # Territories are listed with the name of their entity
+    list_select_related = ("entity",)
+
+
+@admin.register(DiplomaticRelation)
+class DiplomaticRelationAdmin(SimpleHistoryAdmin, admin.ModelAdmin):
+    def get_queryset(self, request):
+        # Relations are listed with the names of their first parties
+        return (
+            super(DiplomaticRelationAdmin, self)
+            .get_queryset(request)
+            .prefetch_related(
+                Prefetch(
+                    "parent_parties", queryset=PoliticalEntity.objects.non_polymorphic()
+                ),
+                Prefetch(
+                    "child_parties", queryset=PoliticalEntity.objects.non_polymorphic()
+                ),
+            )
+        )
 
 
 admin.site.register(PoliticalEntity, SimpleHistoryAdmin)
-admin.site.register(DiplomaticRelation, SimpleHistoryAdmin)
 
 admin.site.site_header = "ChronoScio Database"
 admin.site.site_title = "ChronoScio editor"
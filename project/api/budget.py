@@ -0,0 +1,92 @@
+"""
+Records the SQL queries run while serving a request, and checks them against the
+query_budget (number of queries) and query_time_budget (milliseconds) declared
+by its view
+"""
+import logging
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper counting and timing the queries run through it
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += perf_counter() - start
+
+    @property
+    def milliseconds(self):
+        return self.time * 1000
+
+
+def view_budget(view_func):
+    """
+    Returns the (query_budget, query_time_budget) of a view function or of the
+    class it was created from
+    """
+    view = getattr(view_func, "cls", view_func)
+    return (
+        getattr(view, "query_budget", None),
+        getattr(view, "query_time_budget", None),
+    )
+
+
+class QueryBudgetMiddleware:
+    """
+    Adds X-Query-Count and X-Query-Time headers to every response. Read requests
+    going over the budget of their view are logged, and fail with
+    QueryBudgetExceeded when QUERY_BUDGET_STRICT is set (as in the tests).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+
+        response["X-Query-Count"] = str(recorder.count)
+        response["X-Query-Time"] = "%.1f" % recorder.milliseconds
+        if request.method in ("GET", "HEAD"):
+            self.check(request, recorder)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = view_budget(view_func)
+
+    def check(self, request, recorder):
+        count_budget, time_budget = getattr(request, "query_budget", (None, None))
+        errors = []
+        if count_budget is not None and recorder.count > count_budget:
+            errors.append("%d queries (budget %d)" % (recorder.count, count_budget))
+        if time_budget is not None and recorder.milliseconds > time_budget:
+            errors.append(
+                "%.1fms of queries (budget %dms)" % (recorder.milliseconds, time_budget)
+            )
+        if not errors:
+            return
+
+        message = "%s %s ran %s" % (request.method, request.path, ", ".join(errors))
+        if settings.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
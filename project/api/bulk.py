@@ -0,0 +1,208 @@
+"""
+Set-based creation of many territories at once. The whole batch is validated
+with a couple of queries instead of the per-row checks Territory.save runs, then
+inserted, along with its history and simplified geometries, in a few statements.
+"""
+from collections import defaultdict
+from datetime import date as Date
+
+from django.conf import settings
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException
+from django.db import IntegrityError, connection, transaction
+from django.utils.dateparse import parse_date
+from django.utils.timezone import now
+from psycopg2 import errorcodes
+from rest_framework.exceptions import ValidationError
+
+from . import response_cache
+from .epochs import invalidate_periods
+from .geo import encode_geo, geo_extent, geometry_from_geojson
+from .models import PoliticalEntity, SimplifiedGeometry, Territory
+from .tiles import invalidate_tiles
+
+OVERLAP_MESSAGE = (
+    "Another territory of this PoliticalEntity exists during this timeframe."
+)
+
+# Rows of the batch overlapping a stored territory of the same entity, served by
+# the index of the exclusion constraint on (entity_id, period)
+OVERLAP_SQL = """
+SELECT DISTINCT batch.row_index
+FROM unnest(%s::int[], %s::int[], %s::date[], %s::date[])
+    AS batch(row_index, entity_id, start_date, end_date)
+JOIN {territory} territory ON territory.entity_id = batch.entity_id
+    AND daterange(territory.start_date, territory.end_date, '[]')
+        && daterange(batch.start_date, batch.end_date, '[]')
+""".format(
+    territory=Territory._meta.db_table
+)
+
+
+def to_date(value):
+    if isinstance(value, Date):
+        return value
+    try:
+        return parse_date(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_row(row):
+    """
+    Builds an unsaved Territory from a row, returns it with the row's errors
+    """
+    if not isinstance(row, dict):
+        return None, {"non_field_errors": ["Expected an object."]}
+
+    errors = {}
+    dates = {}
+    for field in ("start_date", "end_date"):
+        dates[field] = to_date(row.get(field))
+        if dates[field] is None:
+            errors[field] = ["A valid date (YYYY-MM-DD) is required."]
+    if not errors and dates["start_date"] > dates["end_date"]:
+        errors["non_field_errors"] = ["Start date cannot be later than end date"]
+
+    references = row.get("references")
+    if not isinstance(references, list) or not references:
+        errors["references"] = ["A list of references is required."]
+
+    if not isinstance(row.get("entity"), int):
+        errors["entity"] = ["A PoliticalEntity id is required."]
+
+    geo = None
+    try:
+        geo = geometry_from_geojson(row["geo"])
+    except (KeyError, IndexError, TypeError, ValueError, GEOSException, GDALException):
+        pass
+    if geo is None:
+        errors["geo"] = ["A valid GeoJSON geometry or FeatureCollection is required."]
+    elif geo.geom_type not in ("Polygon", "MultiPolygon"):
+        errors["geo"] = [
+            "Only Polygon and MultiPolygon objects are acceptable geometry types."
+        ]
+
+    if errors:
+        return None, errors
+    territory = Territory(
+        entity_id=row["entity"],
+        start_date=dates["start_date"],
+        end_date=dates["end_date"],
+        references=references,
+        geo=geo,
+    )
+    # bulk_create skips Territory.clean, normalize here like it would
+    territory.normalize()
+    if territory.geo.empty:
+        return None, {"geo": ["The geometry has no area once normalized."]}
+    return territory, errors
+
+
+def validate_batch(territories, errors):
+    """
+    Records unknown entities and overlapping periods, within the batch and
+    against stored territories, in errors (indexed like territories)
+    """
+    rows = [i for i, territory in enumerate(territories) if territory is not None]
+
+    entity_ids = {territories[i].entity_id for i in rows}
+    known = set(
+        PoliticalEntity.objects.filter(pk__in=entity_ids).values_list("pk", flat=True)
+    )
+    for i in rows:
+        if territories[i].entity_id not in known:
+            errors[i]["entity"] = ["No PoliticalEntity has this id."]
+
+    # Within the batch, a period overlaps when it starts before the latest end
+    # of the earlier periods of its entity
+    by_entity = defaultdict(list)
+    for i in rows:
+        by_entity[territories[i].entity_id].append(i)
+    for indexes in by_entity.values():
+        indexes.sort(key=lambda i: territories[i].start_date)
+        latest_end = None
+        for i in indexes:
+            if latest_end is not None and territories[i].start_date <= latest_end:
+                errors[i].setdefault("non_field_errors", []).append(OVERLAP_MESSAGE)
+            latest_end = max(latest_end or Date.min, territories[i].end_date)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            OVERLAP_SQL,
+            [
+                rows,
+                [territories[i].entity_id for i in rows],
+                [territories[i].start_date for i in rows],
+                [territories[i].end_date for i in rows],
+            ],
+        )
+        for (i,) in cursor.fetchall():
+            errors[i].setdefault("non_field_errors", []).append(OVERLAP_MESSAGE)
+
+
+def history_rows(territories, user):
+    """
+    Builds the creation records simple_history would have saved for each territory
+    """
+    model = Territory.history.model
+    history_date = now()
+    return [
+        model(
+            history_date=history_date,
+            history_type="+",
+            history_user=user,
+            **{
+                field.attname: getattr(territory, field.attname)
+                for field in Territory._meta.fields
+            }
+        )
+        for territory in territories
+    ]
+
+
+def create_territories(rows, user=None):
+    """
+    Validates and creates a list of territory rows, all or nothing. Raises a
+    ValidationError listing the errors of every row if any of them is invalid.
+    """
+    parsed = [parse_row(row) for row in rows]
+    territories = [territory for territory, _ in parsed]
+    errors = [row_errors for _, row_errors in parsed]
+    if territories:
+        validate_batch(territories, errors)
+    if any(errors):
+        raise ValidationError(errors)
+
+    for territory in territories:
+        territory.encoded_geo = encode_geo(territory.geo)
+
+    batch_size = settings.BULK_BATCH_SIZE
+    try:
+        with transaction.atomic():
+            Territory.objects.bulk_create(territories, batch_size=batch_size)
+            Territory.history.model.objects.bulk_create(
+                history_rows(territories, user), batch_size=batch_size
+            )
+            # Territories only have a pk once they are inserted
+            SimplifiedGeometry.objects.bulk_create(
+                [
+                    simplified
+                    for territory in territories
+                    for simplified in territory.build_simplified()
+                ],
+                batch_size=batch_size,
+            )
+    except IntegrityError as error:
+        # A concurrent write got past validation, the exclusion constraint caught it
+        if getattr(error.__cause__, "pgcode", None) != errorcodes.EXCLUSION_VIOLATION:
+            raise
+        raise ValidationError({"non_field_errors": [OVERLAP_MESSAGE]})
+
+    # bulk_create sends no signals, drop the cached tiles and snapshots here
+    invalidate_tiles([geo_extent(territory.geo) for territory in territories])
+    invalidate_periods(
+        [(territory.start_date, territory.end_date) for territory in territories]
+    )
+    response_cache.invalidate("territories")
+    return territories
@@ -0,0 +1,145 @@
+"""
+The territories active on a date only change at the distinct start and end dates
+of territories, so every date between two of these boundaries shares an epoch.
+Serialized snapshots of the territories active during an epoch are cached and
+only dropped for the epochs a changed territory spans.
+
+Boundaries and snapshots are cached under a version (of the boundaries) or a
+generation (of an epoch) read before they are computed. Invalidating bumps the
+counter, so data computed while a change was being written lands under a key
+that is never read again instead of outliving the invalidation.
+"""
+from bisect import bisect_right
+from datetime import date as Date, timedelta
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Territory
+
+BOUNDARIES_KEY = "territory-epochs:boundaries:%s"
+VERSION_KEY = "territory-epochs:version"
+# Generation of every snapshot, on top of the generation of their epoch
+GENERATION_KEY = "territory-snapshot:generation"
+# Geometry encodings snapshots are cached for
+SNAPSHOT_VARIANTS = ("hex", "base64")
+
+# Process local copy of the boundaries, as (version, boundaries)
+_local_boundaries = (None, None)
+
+
+def counter(key):
+    """
+    Returns the current value of a version or generation counter
+    """
+    value = cache.get(key)
+    if value is None:
+        # A fresh value makes sure no key of a dropped counter is reused
+        cache.add(key, int(time() * 1000000), None)
+        value = cache.get(key)
+    return value
+
+
+def bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Nothing was cached yet
+        pass
+
+
+def boundaries():
+    """
+    Returns the sorted first days of every epoch
+    """
+    global _local_boundaries
+
+    version = counter(VERSION_KEY)
+    if _local_boundaries[0] == version:
+        return _local_boundaries[1]
+
+    cached = cache.get(BOUNDARIES_KEY % version)
+    if cached is None:
+        starts = Territory.objects.values_list("start_date", flat=True).distinct()
+        ends = Territory.objects.values_list("end_date", flat=True).distinct()
+        # End dates are inclusive, so their epoch begins on the following day
+        cached = sorted(
+            set(starts) | {end + timedelta(days=1) for end in ends if end < Date.max}
+        )
+        cache.set(BOUNDARIES_KEY % version, cached, None)
+
+    _local_boundaries = (version, cached)
+    return cached
+
+
+def epoch_for(date, bounds=None):
+    """
+    Returns the first date of the epoch containing date, or None if it
+    precedes every territory
+    """
+    bounds = boundaries() if bounds is None else bounds
+    index = bisect_right(bounds, date)
+    return bounds[index - 1] if index else None
+
+
+def epochs_between(start_date, end_date, bounds=None):
+    """
+    Returns the epochs overlapping the inclusive period [start_date, end_date]
+    """
+    bounds = boundaries() if bounds is None else bounds
+    first = bisect_right(bounds, start_date)
+    last = bisect_right(bounds, end_date)
+    return [epoch_for(start_date, bounds)] + bounds[first:last]
+
+
+def generation_key(epoch):
+    return "territory-snapshot:%s:generation" % (
+        epoch.isoformat() if epoch is not None else "origin"
+    )
+
+
+def snapshot_key(epoch, variant):
+    return "territory-snapshot:%s:%s:%s:%s" % (
+        epoch.isoformat() if epoch is not None else "origin",
+        counter(GENERATION_KEY),
+        counter(generation_key(epoch)),
+        variant,
+    )
+
+
+def get_snapshot(date, variant, build):
+    """
+    Returns the cached snapshot of the epoch containing date, calling build
+    to serialize it on a miss
+    """
+    key = snapshot_key(epoch_for(date), variant)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build()
+        cache.set(key, snapshot, settings.SNAPSHOT_CACHE_TIMEOUT)
+    return snapshot
+
+
+def invalidate_periods(periods):
+    """
+    Drops the snapshots of every epoch overlapping the given (start, end) periods,
+    and the boundaries they were computed from. Must be called with the periods
+    both before and after a change.
+    """
+    bounds = boundaries()
+    epochs = set()
+    for start_date, end_date in periods:
+        if start_date is not None and end_date is not None:
+            epochs.update(epochs_between(start_date, end_date, bounds))
+    for epoch in epochs:
+        bump(generation_key(epoch))
+    bump(VERSION_KEY)
+
+
+def invalidate_all():
+    """
+    Drops every snapshot, for changes that are not tied to a period
+    """
+    bump(GENERATION_KEY)
+    bump(VERSION_KEY)
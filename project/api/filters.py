@@ -1,25 +1,158 @@
-from ast import literal_eval as make_tuple
+import re
+from math import ceil, floor, isfinite
 
+from django import forms
+from django.conf import settings
 from django.contrib.gis.geos import Polygon
-from django_filters import FilterSet, Filter, DateFilter, BaseInFilter, widgets
+from django.db.models import Prefetch, Q
+from django_filters import (
+    FilterSet,
+    Filter,
+    BooleanFilter,
+    DateFilter,
+    NumberFilter,
+    BaseInFilter,
+    widgets,
+)
 
-from .models import Territory
+from .models import DiplomaticRelation, Territory, SimplifiedGeometry
+
+COORDINATE_PAIR = re.compile(r"\(\s*([^(),\s]+)\s*,\s*([^(),\s]+)\s*\)")
+
+
+def parse_coordinates(values):
+    """
+    Converts coordinate strings to finite floats, raising ValidationError otherwise
+    """
+    try:
+        coordinates = [float(value) for value in values]
+    except ValueError:
+        raise forms.ValidationError("Coordinates must be numbers.")
+    if not all(isfinite(coordinate) for coordinate in coordinates):
+        raise forms.ValidationError("Coordinates must be finite.")
+    return coordinates
+
+
+class BoundingBoxField(forms.Field):
+    """
+    Parses "minx,miny,maxx,maxy" into a rectangular Polygon
+    """
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        parts = value.split(",")
+        if len(parts) != 4:
+            raise forms.ValidationError("bbox must be minx,miny,maxx,maxy.")
+        xmin, ymin, xmax, ymax = parse_coordinates(parts)
+        if xmin > xmax or ymin > ymax:
+            raise forms.ValidationError("bbox minimums cannot exceed its maximums.")
+        grid = settings.BBOX_GRID_SIZE
+        if grid:
+            # Widen to the grid so that nearby views share cached responses
+            xmin, ymin = floor(xmin / grid) * grid, floor(ymin / grid) * grid
+            xmax, ymax = ceil(xmax / grid) * grid, ceil(ymax / grid) * grid
+        bbox = Polygon.from_bbox((xmin, ymin, xmax, ymax))
+        bbox.srid = 4326
+        return bbox
+
+
+class RingField(forms.Field):
+    """
+    Parses a closed ring of "((x, y), (x, y), ...)" pairs into a Polygon
+    """
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        pairs = COORDINATE_PAIR.findall(value)
+        if len(pairs) < 4:
+            raise forms.ValidationError("bounds must be a ring of (x, y) pairs.")
+        coordinates = parse_coordinates(
+            [coordinate for pair in pairs for coordinate in pair]
+        )
+        ring = list(zip(coordinates[::2], coordinates[1::2]))
+        if ring[0] != ring[-1]:
+            raise forms.ValidationError("bounds must be a closed ring.")
+        return Polygon(ring, srid=4326)
+
+
+class BoundingBoxFilter(Filter):
+    field_class = BoundingBoxField
+
+
+class RingFilter(Filter):
+    field_class = RingField
 
 
 class TerritoryFilter(FilterSet):
-    bounds = Filter(method="filter_bounds")
+    bounds = RingFilter(method="filter_bounds")
+    bbox = BoundingBoxFilter(method="filter_bbox")
+    bbox_exact = BooleanFilter(
+        method="filter_bbox_exact", widget=widgets.BooleanWidget()
+    )
     date = DateFilter(method="filter_date")
     exclude_ids = BaseInFilter(
         field_name="id", exclude=True, widget=widgets.CSVWidget()
     )
+    zoom = NumberFilter(method="filter_zoom")
 
     def filter_bounds(self, queryset, field_name, value):
-        geom = Polygon(make_tuple(value), srid=4326)
-        return queryset.filter(geo__intersects=geom)
+        return queryset.filter(geo__intersects=value)
+
+    def filter_bbox(self, queryset, field_name, value):
+        # && only compares bounding boxes and is answered by the GiST index on geo
+        queryset = queryset.filter(geo__bboverlaps=value)
+        if self.form.cleaned_data.get("bbox_exact") is False:
+            return queryset
+        return queryset.filter(geo__intersects=value)
+
+    def filter_bbox_exact(self, queryset, field_name, value):
+        # Only changes how bbox is applied
+        return queryset
 
     def filter_date(self, queryset, field_name, value):
-        return queryset.filter(start_date__lte=value, end_date__gte=value)
+        return queryset.active_on(value)
+
+    def filter_zoom(self, queryset, field_name, value):
+        # Serve the coarsest precomputed level that is still detailed enough
+        levels = [zoom for zoom in settings.TERRITORY_ZOOM_LEVELS if zoom >= value]
+        if not levels:
+            return queryset
+        return queryset.prefetch_related(
+            Prefetch(
+                "simplified",
+                queryset=SimplifiedGeometry.objects.filter(zoom=min(levels)),
+                to_attr="simplified_geo",
+            )
+        )
 
     class Meta:
         model = Territory
         fields = ("entity",)
+
+
+class DiplomaticRelationFilter(FilterSet):
+    date = DateFilter(method="filter_date")
+    entity = NumberFilter(method="filter_entity")
+
+    def filter_date(self, queryset, field_name, value):
+        return queryset.active_on(value)
+
+    def filter_entity(self, queryset, field_name, value):
+        # Subqueries on the party tables instead of joins, which would repeat
+        # relations and need a DISTINCT
+        parents = DiplomaticRelation.parent_parties.through.objects.filter(
+            politicalentity_id=value
+        )
+        children = DiplomaticRelation.child_parties.through.objects.filter(
+            politicalentity_id=value
+        )
+        return queryset.filter(
+            Q(pk__in=parents.values("diplomaticrelation_id"))
+            | Q(pk__in=children.values("diplomaticrelation_id"))
+        )
+
+    class Meta:
+        model = DiplomaticRelation
+        fields = ("diplo_type",)
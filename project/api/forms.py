@@ -1,50 +1,28 @@
-import glob
-import shutil
-import os
-
 from django import forms
-from django.contrib.gis import geos, gdal
+from django.conf import settings
 from .models import Territory
-from zipfile import ZipFile
-from tempfile import mkdtemp
-from django.core.exceptions import ValidationError
+from .shapefiles import ShapefileError, read_shapefile
 
 
 class TerritoryForm(forms.ModelForm):
 
     shape_file = forms.FileField(required=False)
 
+    def clean_shape_file(self):
+        # The archive is read in memory, nothing is extracted to disk
+        shape_file = self.cleaned_data["shape_file"]
+        if shape_file is None:
+            return None
+        try:
+            return read_shapefile(shape_file.read(), workers=settings.SHAPEFILE_WORKERS)
+        except ShapefileError as error:
+            raise forms.ValidationError(str(error))
+
     def save(self, commit=True):
 
         model = super(TerritoryForm, self).save(commit=False)
         if not self.cleaned_data["shape_file"] is None:
-            shape_file = self.cleaned_data["shape_file"]
-            working_dir = mkdtemp()
-            try:
-                shape_zip = ZipFile(shape_file)
-                shape_zip.extractall(working_dir)
-            except:
-                shutil.rmtree(working_dir)
-                raise ValidationError("Could not extract zipfile.")
-
-            basename = os.path.splitext(os.path.basename(shape_file.name))[0]
-            shapes_list = glob.glob(working_dir + "/" + basename + "/*.shp")
-
-            try:
-                ds = gdal.DataSource(shapes_list[0])
-                layer = ds[0]
-                polygons = []
-                for feature in layer:
-                    geom = feature.geom.geos
-                    if isinstance(geom, geos.Polygon):
-                        polygons.append(geom)
-
-                if len(polygons) > 0:
-                    multipoly = geos.MultiPolygon(polygons)
-                    model.geo = multipoly.geojson
-            except:
-                shutil.rmtree(working_dir)
-                raise ValidationError("Error converting shapefile")
+            model.geo = self.cleaned_data["shape_file"]
 
         if commit:
             model.save()
@@ -0,0 +1,211 @@
+"""
+Geometry helpers shared by the models, serializers and management commands
+"""
+from decimal import Decimal
+from json import loads, dumps
+
+import geobuf
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+from django.db import connection
+
+
+def encode_geo(geometry):
+    """
+    Compresses a GEOS geometry to geobuf, returns None for empty geometries
+    """
+    if geometry is None:
+        return None
+    return geobuf.encode(loads(geometry.geojson))
+
+
+def geo_extent(geometry):
+    """
+    Returns the (xmin, ymin, xmax, ymax) extent of a geometry, None if it is empty
+    """
+    if geometry is None or geometry.empty:
+        return None
+    return geometry.extent
+
+
+def zoom_tolerance(zoom):
+    """
+    Width in degrees of a single pixel of a 256px web map tile at the given zoom
+    """
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def grid_digits(grid):
+    """
+    Returns the number of decimals of a grid size, 6 for 0.000001
+    """
+    return max(0, -Decimal(repr(grid)).normalize().as_tuple().exponent)
+
+
+def snap(ring, grid):
+    # Rounding to the decimals of the grid drops the float noise of the product
+    digits = grid_digits(grid)
+    return [
+        (round(round(x / grid) * grid, digits), round(round(y / grid) * grid, digits))
+        for x, y, *_ in ring
+    ]
+
+
+def polygons_from_geojson(geometry, grid=None):
+    """
+    Builds the polygons of a GeoJSON Polygon or MultiPolygon straight from its
+    coordinates, optionally snapped to a grid of the given size in degrees
+    """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return []
+    if grid:
+        polygons = [[snap(ring, grid) for ring in rings] for rings in polygons]
+    return [Polygon(*rings, srid=4326) for rings in polygons]
+
+
+def geometry_from_geojson(value, grid=None):
+    """
+    Builds a GEOS geometry from a GeoJSON string or dict. FeatureCollections are
+    merged into the cascaded union of their Polygon and MultiPolygon features,
+    None is returned when they have none.
+    """
+    geojson = loads(value) if isinstance(value, str) else value
+    if geojson["type"] != "FeatureCollection":
+        return GEOSGeometry(value if isinstance(value, str) else dumps(value))
+
+    grid = settings.GEOMETRY_GRID_SIZE if grid is None else grid
+    polygons = [
+        polygon
+        for feature in geojson["features"]
+        if feature.get("geometry")
+        for polygon in polygons_from_geojson(feature["geometry"], grid)
+    ]
+    if not polygons:
+        return None
+    # A single union of all parts is much cheaper than merging them one at a time
+    return MultiPolygon(polygons, srid=4326).unary_union
+
+
+def is_collinear(a, b, c):
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]) == 0
+
+
+def clean_ring(ring):
+    """
+    Drops the repeated and collinear vertices of a closed ring (spikes going
+    back on themselves included), returns None if it collapses
+    """
+    points = []
+    for x, y, *_ in ring[:-1]:
+        point = (x, y)
+        while len(points) >= 2 and is_collinear(points[-2], points[-1], point):
+            points.pop()
+        if not points or point != points[-1]:
+            points.append(point)
+    # The ring wraps around, its first and last vertices need the same checks
+    while len(points) >= 3:
+        if points[-1] == points[0] or is_collinear(points[-2], points[-1], points[0]):
+            points.pop()
+        elif is_collinear(points[-1], points[0], points[1]):
+            points.pop(0)
+        else:
+            break
+    if len(points) < 3:
+        return None
+    return points + [points[0]]
+
+
+def ring_area(ring):
+    """
+    Signed area of a closed ring, positive when it turns counterclockwise
+    """
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:])) / 2
+
+
+def orient(ring, counterclockwise):
+    if (ring_area(ring) > 0) == counterclockwise:
+        return ring
+    return ring[::-1]
+
+
+def make_valid(geometry):
+    """
+    Repairs a geometry with PostGIS, which unlike buffer(0) keeps every part of
+    self-intersecting rings. Returns the polygons of the result.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ST_AsEWKB(ST_CollectionExtract(ST_MakeValid(ST_GeomFromEWKB(%s)), 3))",
+            [bytes(geometry.ewkb)],
+        )
+        return GEOSGeometry(memoryview(cursor.fetchone()[0]))
+
+
+def polygon_coords(geometry):
+    """
+    Returns the rings of each polygon of a Polygon or MultiPolygon
+    """
+    if geometry.empty:
+        return []
+    if geometry.geom_type == "Polygon":
+        return [geometry.coords]
+    return [polygon.coords for polygon in geometry]
+
+
+def clean_polygons(polygons, grid=None):
+    """
+    Snaps and cleans up the rings of each polygon, and orients them following
+    the right hand rule of RFC 7946: exterior rings counterclockwise and holes
+    clockwise. Polygons whose exterior ring collapses are dropped.
+    """
+    cleaned = []
+    for rings in polygons:
+        if grid:
+            rings = [snap(ring, grid) for ring in rings]
+        exterior, *holes = [clean_ring(ring) for ring in rings]
+        if exterior is None:
+            continue
+        cleaned.append(
+            [orient(exterior, True)]
+            + [orient(hole, False) for hole in holes if hole is not None]
+        )
+    return cleaned
+
+
+def normalize_geometry(geometry, grid=None):
+    """
+    Returns a Polygon or MultiPolygon snapped to a grid of the given size in
+    degrees (GEOMETRY_GRID_SIZE by default), without repeated or collinear
+    vertices, valid and with oriented rings. Polygons stay Polygons unless the
+    repair splits them.
+    """
+    grid = settings.GEOMETRY_GRID_SIZE if grid is None else grid
+    srid = geometry.srid
+    polygons = clean_polygons(polygon_coords(geometry), grid)
+    parts = [Polygon(*rings, srid=srid) for rings in polygons]
+    normalized = MultiPolygon(parts, srid=srid)
+    if not normalized.valid:
+        # Self-intersecting rings are split into valid polygons, then the parts
+        # overlapping each other are merged. Both come out with their own
+        # orientation and vertices.
+        repaired = []
+        for part in parts:
+            repaired.extend(
+                polygon_coords(part) if part.valid else polygon_coords(make_valid(part))
+            )
+        normalized = MultiPolygon(
+            [Polygon(*rings, srid=srid) for rings in repaired], srid=srid
+        )
+        if not normalized.valid:
+            normalized = normalized.unary_union
+        polygons = clean_polygons(polygon_coords(normalized))
+        normalized = MultiPolygon(
+            [Polygon(*rings, srid=srid) for rings in polygons], srid=srid
+        )
+    if geometry.geom_type == "Polygon" and len(normalized) == 1:
+        return normalized[0]
+    return normalized
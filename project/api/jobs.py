@@ -0,0 +1,151 @@
+"""
+Background jobs queued in the database and claimed by workers with
+SELECT ... FOR UPDATE SKIP LOCKED, so no broker is needed.
+
+A worker holds a session advisory lock on the jobs it runs. PostgreSQL releases
+it when the session ends, so a running job whose lock is free was left behind by
+a dead worker.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.timezone import now
+from rest_framework.exceptions import ValidationError
+
+from . import response_cache
+from .bulk import create_territories
+from .models import Job, Territory
+
+logger = logging.getLogger(__name__)
+
+# First key of the advisory locks held on running jobs, the second one is their id
+JOB_LOCK_SPACE = 7305
+
+# Task functions by kind, each takes the job payload and its user
+TASKS = {}
+
+
+def task(kind):
+    """
+    Registers a function as the task run for jobs of the given kind
+    """
+
+    def register(function):
+        TASKS[kind] = function
+        return function
+
+    return register
+
+
+def enqueue(kind, payload, user=None):
+    if kind not in TASKS:
+        raise KeyError("No task is registered for %s jobs" % kind)
+    return Job.objects.create(kind=kind, payload=payload, user=user)
+
+
+def lock(job):
+    """
+    Takes the advisory lock of a job for the current session, returns whether it
+    was free
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [JOB_LOCK_SPACE, job.pk])
+        return cursor.fetchone()[0]
+
+
+def unlock(job):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [JOB_LOCK_SPACE, job.pk])
+
+
+def claim():
+    """
+    Marks the oldest queued job as running, locks it and returns it, or None if
+    the queue is empty. Jobs locked by other workers are skipped instead of
+    waited for.
+
+    Running jobs whose advisory lock is free were left behind by a worker that
+    died, and are claimed again. They fail once they were claimed
+    JOB_MAX_ATTEMPTS times.
+    """
+    # Running jobs whose worker is alive
+    skipped = []
+    while True:
+        with transaction.atomic():
+            job = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(status__in=(Job.QUEUED, Job.RUNNING))
+                .exclude(pk__in=skipped)
+                .order_by("id")
+                .first()
+            )
+            if job is None:
+                return None
+            # The lock is taken before the job is marked as running, so its
+            # worker holds it for as long as the job is seen running
+            if not lock(job):
+                skipped.append(job.pk)
+                continue
+            if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+                job.status = Job.FAILED
+                job.result = {
+                    "errors": [
+                        "No worker finished the job in %d attempts." % job.attempts
+                    ]
+                }
+                job.finished = now()
+                job.save(update_fields=["status", "result", "finished"])
+                unlock(job)
+                continue
+            job.status = Job.RUNNING
+            job.started = now()
+            job.attempts += 1
+            job.save(update_fields=["status", "started", "attempts"])
+        return job
+
+
+def run(job):
+    """
+    Runs a claimed job, storing its return value or its errors, and releases its
+    lock
+    """
+    try:
+        job.result = TASKS[job.kind](job.payload, job.user)
+        job.status = Job.DONE
+    except ValidationError as error:
+        job.result = {"errors": error.detail}
+        job.status = Job.FAILED
+    except Exception as error:
+        logger.exception("Job %d failed", job.pk)
+        job.result = {"errors": [str(error)]}
+        job.status = Job.FAILED
+    job.finished = now()
+    try:
+        job.save(update_fields=["result", "status", "finished"])
+    finally:
+        unlock(job)
+    return job
+
+
+def run_next():
+    """
+    Claims and runs the next queued job, returns it or None if there was none
+    """
+    job = claim()
+    return run(job) if job is not None else None
+
+
+@task("create_territories")
+def create_territories_task(payload, user):
+    territories = create_territories(payload["rows"], user=user)
+    return {"created": [territory.pk for territory in territories]}
+
+
+@task("simplify_territories")
+def simplify_territories_task(payload, user):
+    with transaction.atomic():
+        for territory in Territory.objects.filter(pk__in=payload["ids"]):
+            territory.simplify()
+    response_cache.invalidate("territories")
+    return {"simplified": len(payload["ids"])}
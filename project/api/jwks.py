@@ -0,0 +1,188 @@
+"""
+Process wide cache of the keys Auth0 signs access tokens with, looked up by kid
+"""
+import json
+import re
+import threading
+import time
+
+import jwt
+from django.conf import settings
+from six.moves.urllib import request as req
+from cryptography.x509 import load_pem_x509_certificate
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from jwt.algorithms import RSAAlgorithm
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class SigningKeyNotFound(jwt.InvalidTokenError):
+    pass
+
+
+def public_key(jwk):
+    """
+    Loads the public key of a JWK, from its X.509 certificate when it has one
+    """
+    if jwk.get("x5c"):
+        # Add a line-break every 64 chars
+        body = re.sub("(.{64})", "\\1\n", jwk["x5c"][0], 0, re.DOTALL)
+        cert = "-----BEGIN CERTIFICATE-----\n" + body + "\n-----END CERTIFICATE-----"
+        certificate = load_pem_x509_certificate(cert.encode("utf-8"), default_backend())
+        return certificate.public_key()
+    return RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+
+def parse_jwks(jwks):
+    return {jwk.get("kid"): public_key(jwk) for jwk in jwks["keys"]}
+
+
+class URLSource:
+    """
+    Fetches a JWKS over HTTP, honouring the max-age of its Cache-Control header
+    """
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        response = req.urlopen(self.url, timeout=self.timeout)
+        max_age = MAX_AGE.search(response.headers.get("Cache-Control", ""))
+        return (
+            parse_jwks(json.loads(response.read().decode("utf-8"))),
+            int(max_age.group(1)) if max_age else None,
+        )
+
+
+class FileSource:
+    """
+    Reads a JWKS from a local file, for offline development and tests
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        with open(self.path) as jwks:
+            return parse_jwks(json.load(jwks)), None
+
+
+class PEMFileSource:
+    """
+    Reads a single PEM public key or certificate from a local file, the key
+    is used for every kid
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        with open(self.path, "rb") as pem:
+            data = pem.read()
+        if b"BEGIN CERTIFICATE" in data:
+            key = load_pem_x509_certificate(data, default_backend()).public_key()
+        else:
+            key = load_pem_public_key(data, default_backend())
+        return {None: key}, None
+
+
+class KeyCache:
+    """
+    Keeps the parsed keys of a JWKS source for ttl seconds (or the max-age the
+    source returned). Expired keys keep being served while a background thread
+    refreshes them, and the source is only hit synchronously on the first lookup
+    or for an unknown kid, at most once every min_interval seconds.
+    """
+
+    def __init__(self, source, ttl=3600, min_interval=30):
+        self.source = source
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.keys = {}
+        self.expires = 0
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self):
+        keys, max_age = self.source()
+        with self.lock:
+            self.keys = keys
+            self.fetched = time.time()
+            self.expires = self.fetched + (max_age if max_age is not None else self.ttl)
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the current keys, the next lookup retries
+                pass
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, kid=None):
+        """
+        Returns the public key for kid, or the first key when kid is None
+        """
+        if not self.keys:
+            try:
+                self.refresh()
+            except Exception as error:
+                raise SigningKeyNotFound("Could not load signing keys: %s" % error)
+        elif time.time() >= self.expires:
+            self.refresh_in_background()
+
+        if (kid is None or None in self.keys) and self.keys:
+            return self.keys.get(kid) or next(iter(self.keys.values()))
+        if kid not in self.keys and time.time() - self.fetched >= self.min_interval:
+            # The keys may have been rotated
+            try:
+                self.refresh()
+            except Exception:
+                pass
+        try:
+            return self.keys[kid]
+        except KeyError:
+            raise SigningKeyNotFound("No signing key matches kid %s" % kid)
+
+
+_key_cache = None
+_key_cache_lock = threading.Lock()
+
+
+def key_cache():
+    """
+    Returns the process wide KeyCache, created on first use. Keys are read from
+    AUTH0_JWKS_FILE or AUTH0_PUBLIC_KEY_FILE when set, and from the Auth0
+    tenant otherwise.
+    """
+    global _key_cache
+    with _key_cache_lock:
+        if _key_cache is None:
+            if settings.AUTH0_JWKS_FILE:
+                source = FileSource(settings.AUTH0_JWKS_FILE)
+            elif settings.AUTH0_PUBLIC_KEY_FILE:
+                source = PEMFileSource(settings.AUTH0_PUBLIC_KEY_FILE)
+            else:
+                source = URLSource(
+                    "https://" + settings.AUTH0_DOMAIN + "/.well-known/jwks.json"
+                )
+            _key_cache = KeyCache(source, ttl=settings.JWKS_CACHE_TTL)
+    return _key_cache
+
+
+def signing_key(token):
+    """
+    Returns the public key an access token was signed with
+    """
+    return key_cache().get(jwt.get_unverified_header(token).get("kid"))
@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from api.geo import encode_geo
+from api.models import Territory
+
+
+def encode_batch(model, pks):
+    """
+    Rebuilds the stored geobuf of the given rows without touching their history
+    """
+    with transaction.atomic():
+        for pk, geo in model.objects.filter(pk__in=pks).values_list("pk", "geo"):
+            model.objects.filter(pk=pk).update(encoded_geo=encode_geo(geo))
+    return len(pks)
+
+
+class Command(BaseCommand):
+    """
+    Backfills Territory.encoded_geo (and optionally its history) in parallel
+    """
+
+    help = "Precomputes the geobuf payload served for each territory"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Re-encode every row instead of only rows missing a payload",
+        )
+        parser.add_argument(
+            "--history",
+            action="store_true",
+            help="Also backfill the historical territory table",
+        )
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        models = [Territory]
+        if options["history"]:
+            models.append(Territory.history.model)
+
+        for model in models:
+            queryset = model.objects.all()
+            if not options["all"]:
+                queryset = queryset.filter(encoded_geo__isnull=True)
+            pks = list(queryset.order_by("pk").values_list("pk", flat=True))
+            batch_size = options["batch_size"]
+            batches = [pks[i : i + batch_size] for i in range(0, len(pks), batch_size)]
+
+            # Forked workers must open their own connections
+            connections.close_all()
+            done = 0
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                for count in executor.map(
+                    encode_batch, [model] * len(batches), batches
+                ):
+                    done += count
+                    self.stdout.write("%s: %d/%d" % (model.__name__, done, len(pks)))
+
+            self.stdout.write(
+                self.style.SUCCESS("Encoded %d %s rows" % (done, model.__name__))
+            )
@@ -0,0 +1,79 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from api import response_cache
+from api.epochs import invalidate_all
+from api.geo import encode_geo, geo_extent
+from api.models import Territory
+from api.tiles import invalidate_tiles
+
+
+def normalize_batch(pks):
+    """
+    Normalizes the geometry of the given territories without touching their
+    history, returns the extents of the ones whose geometry changed
+    """
+    extents = []
+    with transaction.atomic():
+        for territory in Territory.objects.filter(pk__in=pks):
+            previous = territory.geo
+            territory.normalize()
+            # Left for an editor to fix, saving them would fail
+            if territory.geo.empty:
+                continue
+            Territory.objects.filter(pk=territory.pk).update(
+                geo=territory.geo,
+                encoded_geo=encode_geo(territory.geo),
+                raw_vertex_count=territory.raw_vertex_count,
+                vertex_count=territory.vertex_count,
+            )
+            if territory.geo.ewkb != previous.ewkb:
+                territory.simplify()
+                extents.extend([geo_extent(previous), geo_extent(territory.geo)])
+    return extents
+
+
+class Command(BaseCommand):
+    """
+    Normalizes the territories saved before geometries were normalized, in parallel
+    """
+
+    help = "Normalizes the geometry of territories saved before it was normalized"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        # Only normalized geometries have a vertex count
+        pks = list(
+            Territory.objects.filter(vertex_count__isnull=True, geo__isnull=False)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        batch_size = options["batch_size"]
+        batches = [pks[i : i + batch_size] for i in range(0, len(pks), batch_size)]
+
+        # Forked workers must open their own connections
+        connections.close_all()
+        done = 0
+        extents = []
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            for batch, changed in zip(batches, executor.map(normalize_batch, batches)):
+                done += len(batch)
+                extents.extend(changed)
+                self.stdout.write("%d/%d" % (done, len(pks)))
+
+        # Updates send no signals, drop what was cached from the previous geometries
+        if extents:
+            invalidate_all()
+            invalidate_tiles(extents)
+            response_cache.invalidate("territories")
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Normalized %d legacy territories, %d of them changed"
+                % (done, len(extents) // 2)
+            )
+        )
@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils.timezone import now
+
+from api import response_cache
+from api.models import Job, Territory
+
+
+def simplify_batch(pks):
+    """
+    Rebuilds the simplified geometries of the given territories
+    """
+    with transaction.atomic():
+        for territory in Territory.objects.filter(pk__in=pks):
+            territory.simplify()
+    return len(pks)
+
+
+class Command(BaseCommand):
+    """
+    Regenerates the zoom level geometries of every territory in parallel
+    """
+
+    help = "Precomputes the simplified geometries served to low zoom levels"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        pks = list(Territory.objects.order_by("pk").values_list("pk", flat=True))
+        batch_size = options["batch_size"]
+        batches = [pks[i : i + batch_size] for i in range(0, len(pks), batch_size)]
+
+        # Forked workers must open their own connections
+        connections.close_all()
+        done = 0
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            for count in executor.map(simplify_batch, batches):
+                done += count
+                self.stdout.write("%d/%d" % (done, len(pks)))
+
+        # Zoomed responses served the previous geometries, the finished job changes
+        # their ETag like the rebuilds run by workers
+        Job.objects.create(
+            kind="simplify_territories",
+            payload={"ids": pks},
+            status=Job.DONE,
+            result={"simplified": done},
+            finished=now(),
+        )
+        response_cache.invalidate("territories")
+        self.stdout.write(self.style.SUCCESS("Simplified %d territories" % done))
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.jobs import run_next
+
+
+class Command(BaseCommand):
+    """
+    Runs queued background jobs, several workers can share the queue
+    """
+
+    help = "Runs the jobs queued by the API until interrupted"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling it",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before polling an empty queue again",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = run_next()
+            if job is not None:
+                self.stdout.write("%s" % job)
+                continue
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
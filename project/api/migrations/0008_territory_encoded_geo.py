@@ -0,0 +1,23 @@
+# Generated by Django 2.1.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_auto_20181025_0248'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalterritory',
+            name='encoded_geo',
+            field=models.BinaryField(editable=False, help_text='Geobuf encoding of geo, rebuilt whenever the territory is saved', null=True),
+        ),
+        migrations.AddField(
+            model_name='territory',
+            name='encoded_geo',
+            field=models.BinaryField(editable=False, help_text='Geobuf encoding of geo, rebuilt whenever the territory is saved', null=True),
+        ),
+    ]
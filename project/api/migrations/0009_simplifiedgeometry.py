@@ -0,0 +1,29 @@
+# Generated by Django 2.1.2 on 2026-10-18 10:03
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_territory_encoded_geo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedGeometry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField(help_text='Web map zoom level this geometry was simplified for')),
+                ('geo', django.contrib.gis.db.models.fields.GeometryField(srid=4326)),
+                ('encoded_geo', models.BinaryField()),
+                ('territory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simplified', to='api.Territory')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='simplifiedgeometry',
+            unique_together={('territory', 'zoom')},
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.2 on 2026-10-18 11:27
+
+import django.contrib.postgres.operations
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_simplifiedgeometry'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.BtreeGistExtension(),
+        migrations.RunSQL(
+            "CREATE INDEX api_territory_period_gist ON api_territory "
+            "USING gist (daterange(start_date, end_date, '[]'));",
+            "DROP INDEX api_territory_period_gist;",
+        ),
+        migrations.RunSQL(
+            "ALTER TABLE api_territory ADD CONSTRAINT api_territory_entity_period_excl "
+            "EXCLUDE USING gist (entity_id WITH =, daterange(start_date, end_date, '[]') WITH &&);",
+            "ALTER TABLE api_territory DROP CONSTRAINT api_territory_entity_period_excl;",
+        ),
+    ]
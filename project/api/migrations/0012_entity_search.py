@@ -0,0 +1,36 @@
+# Generated by Django 2.1.2 on 2026-10-18 15:40
+
+import django.contrib.postgres.operations
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_job'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.TrigramExtension(),
+        # array_to_string is only STABLE, an IMMUTABLE wrapper can be indexed
+        migrations.RunSQL(
+            "CREATE FUNCTION api_entity_aliases_text(text[]) RETURNS text "
+            "AS $$ SELECT array_to_string($1, ' ') $$ LANGUAGE sql IMMUTABLE;",
+            "DROP FUNCTION api_entity_aliases_text(text[]);",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX api_entity_name_trgm ON api_entity "
+            "USING gin (name gin_trgm_ops);",
+            "DROP INDEX api_entity_name_trgm;",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX api_entity_aliases_trgm ON api_entity "
+            "USING gin (api_entity_aliases_text(aliases) gin_trgm_ops);",
+            "DROP INDEX api_entity_aliases_trgm;",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX api_entity_description_fts ON api_entity "
+            "USING gin (to_tsvector('english', description));",
+            "DROP INDEX api_entity_description_fts;",
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.1.2 on 2026-10-18 17:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_entity_search'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX api_diplomaticrelation_period_gist ON api_diplomaticrelation "
+            "USING gist (daterange(start_date, end_date, '[]'));",
+            "DROP INDEX api_diplomaticrelation_period_gist;",
+        ),
+        # Lookups by party only read the index, the unique constraints Django
+        # creates lead with the relation instead
+        migrations.RunSQL(
+            "CREATE INDEX api_diplomaticrelation_parent_parties_entity ON api_diplomaticrelation_parent_parties "
+            "(politicalentity_id, diplomaticrelation_id);",
+            "DROP INDEX api_diplomaticrelation_parent_parties_entity;",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX api_diplomaticrelation_child_parties_entity ON api_diplomaticrelation_child_parties "
+            "(politicalentity_id, diplomaticrelation_id);",
+            "DROP INDEX api_diplomaticrelation_child_parties_entity;",
+        ),
+    ]
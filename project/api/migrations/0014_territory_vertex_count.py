@@ -0,0 +1,33 @@
+# Generated by Django 2.1.2 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_diplomaticrelation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalterritory',
+            name='raw_vertex_count',
+            field=models.PositiveIntegerField(editable=False, help_text='Number of vertices of geo as it was submitted', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalterritory',
+            name='vertex_count',
+            field=models.PositiveIntegerField(editable=False, help_text='Number of vertices of geo once normalized', null=True),
+        ),
+        migrations.AddField(
+            model_name='territory',
+            name='raw_vertex_count',
+            field=models.PositiveIntegerField(editable=False, help_text='Number of vertices of geo as it was submitted', null=True),
+        ),
+        migrations.AddField(
+            model_name='territory',
+            name='vertex_count',
+            field=models.PositiveIntegerField(editable=False, help_text='Number of vertices of geo once normalized', null=True),
+        ),
+    ]
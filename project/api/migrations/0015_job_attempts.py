@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-18 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_territory_vertex_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Number of times a worker claimed the job'),
+        ),
+    ]
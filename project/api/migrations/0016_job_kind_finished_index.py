@@ -0,0 +1,17 @@
+# Generated by Django 2.1.2 on 2026-10-18 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_job_attempts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['kind', 'finished'], name='api_job_kind_8f323f_idx'),
+        ),
+    ]
@@ -0,0 +1,168 @@
+from calendar import timegm
+from hashlib import md5
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from . import response_cache
+
+
+class EarlyResponse(Exception):
+    """
+    Raised while a request is initialized to answer it with response, without
+    running its handler
+    """
+
+    def __init__(self, response):
+        super(EarlyResponse, self).__init__()
+        self.response = response
+
+
+class EarlyResponseMixin:
+    def handle_exception(self, exc):
+        if isinstance(exc, EarlyResponse):
+            return exc.response
+        return super(EarlyResponseMixin, self).handle_exception(exc)
+
+
+class ConditionalGetMixin(EarlyResponseMixin):
+    """
+    Sends ETag and Last-Modified headers derived from the latest history records
+    of the models a viewset's responses depend on, and answers matching
+    If-None-Match/If-Modified-Since requests with 304 before any query or
+    serialization is run.
+
+    Every save and delete adds a history record with a larger history_id, so
+    the newest one is found with a single backward scan of its primary key.
+    """
+
+    # Models with HistoricalRecords whose changes show up in the responses
+    history_models = ()
+
+    def get_history_models(self):
+        return self.history_models
+
+    def latest_history(self):
+        """
+        Returns the (history_id, history_date) of the newest record of each model
+        """
+        return [
+            model.history.order_by("-history_id")
+            .values_list("history_id", "history_date")
+            .first()
+            for model in self.get_history_models()
+        ]
+
+    def validators(self, request):
+        latest = self.latest_history()
+        # Responses in different formats must not share an ETag
+        key = "%s:%s" % (
+            getattr(request.accepted_renderer, "format", ""),
+            ",".join(str(record[0]) if record else "-" for record in latest),
+        )
+        dates = [record[1] for record in latest if record]
+        last_modified = timegm(max(dates).utctimetuple()) if dates else None
+        return quote_etag(md5(key.encode("utf-8")).hexdigest()), last_modified
+
+    def initial(self, request, *args, **kwargs):
+        super(ConditionalGetMixin, self).initial(request, *args, **kwargs)
+        self.etag = self.last_modified = None
+        if request.method not in ("GET", "HEAD"):
+            return
+
+        self.etag, self.last_modified = self.validators(request)
+        response = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified
+        )
+        if response is not None:
+            raise EarlyResponse(response)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(
+            request, response, *args, **kwargs
+        )
+        if getattr(self, "etag", None) and response.status_code in (200, 304):
+            response["ETag"] = self.etag
+            if self.last_modified is not None:
+                response["Last-Modified"] = http_date(self.last_modified)
+        return response
+
+
+class CachedResponseMixin(EarlyResponseMixin):
+    """
+    Serves the list and retrieve actions from the response cache, skipping the
+    queries and serializers on a hit. Receivers in signals.py invalidate the
+    cached resource whenever one of the models it depends on changes.
+    """
+
+    # Name the responses of the viewset are cached and invalidated under
+    cache_resource = None
+    cached_actions = ("list", "retrieve")
+
+    def cache_params(self, request):
+        """
+        Returns the sorted (name, values) pairs the response depends on, viewsets
+        can normalize them so that equivalent requests share a response
+        """
+        return sorted(request.query_params.lists())
+
+    def initial(self, request, *args, **kwargs):
+        super(CachedResponseMixin, self).initial(request, *args, **kwargs)
+        self.response_key = None
+        if request.method != "GET" or self.action not in self.cached_actions:
+            return
+
+        params = (
+            self.cache_params(request),
+            getattr(request.accepted_renderer, "format", ""),
+            sorted(kwargs.items()),
+        )
+        self.response_key = response_cache.response_key(self.cache_resource, params)
+        data = response_cache.response_cache().get(self.response_key)
+        if data is None:
+            response_cache.count(self.cache_resource, "misses")
+            return
+
+        response_cache.count(self.cache_resource, "hits")
+        self.response_key = None
+        raise EarlyResponse(Response(data))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if (
+            getattr(self, "response_key", None)
+            and isinstance(response, Response)
+            and response.status_code == 200
+        ):
+            response_cache.response_cache().set(self.response_key, response.data, None)
+            self.response_key = None
+        return super(CachedResponseMixin, self).finalize_response(
+            request, response, *args, **kwargs
+        )
+
+
+class SparseQuerysetMixin:
+    """
+    Defers the model fields the serializer of a read request does not need, so
+    that large columns left out with ?fields= or ?omit= are never fetched
+    """
+
+    # Fields needed whatever the serializer reads
+    always_loaded = ()
+
+    def get_queryset(self):
+        queryset = super(SparseQuerysetMixin, self).get_queryset()
+        if self.request.method not in ("GET", "HEAD"):
+            return queryset
+
+        needed = self.get_serializer().model_fields()
+        deferred = [
+            field.name
+            for field in queryset.model._meta.concrete_fields
+            # Foreign keys are small, and may be followed by select_related
+            if not field.primary_key
+            and not field.is_relation
+            and field.name not in needed
+            and field.name not in self.always_loaded
+        ]
+        return queryset.defer(*deferred) if deferred else queryset
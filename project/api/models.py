@@ -1,15 +1,33 @@
-from json import loads
-
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, DateRangeField, JSONField
+from django.db import IntegrityError, transaction
+from psycopg2 import errorcodes
+from psycopg2.extras import DateRange
 from simple_history.models import HistoricalRecords
 from colorfield.fields import ColorField
 from polymorphic.models import PolymorphicModel, PolymorphicManager
 
+from .geo import encode_geo, normalize_geometry, zoom_tolerance
+
 # Create your models here.
 
 
+class Period(models.Func):
+    """
+    Inclusive date range covered by a model with start_date and end_date fields,
+    matching the expression its GiST index is built on
+    """
+
+    function = "daterange"
+    template = "%(function)s(%(expressions)s, '[]')"
+    output_field = DateRangeField()
+
+    def __init__(self, **extra):
+        super(Period, self).__init__("start_date", "end_date", **extra)
+
+
 class EntityManager(PolymorphicManager):
     """
     Manager for the Nation model to handle lookups by url_id
@@ -85,43 +103,79 @@ class PoliticalEntity(Entity):
     # TODO: implement this
 
 
+class PeriodQuerySet(models.QuerySet):
+    """
+    Date lookups for models with start_date and end_date fields, backed by the
+    GiST index on their period
+    """
+
+    def active_on(self, date):
+        return self.annotate(period=Period()).filter(period__contains=date)
+
+    def overlapping(self, start_date, end_date):
+        return self.annotate(period=Period()).filter(
+            period__overlap=DateRange(start_date, end_date, "[]")
+        )
+
+
 class Territory(models.Model):
     """
     Defines the borders and controlled territories associated with an Entity.
     """
 
+    objects = PeriodQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "territories"
 
     start_date = models.DateField(help_text="When this border takes effect")
     end_date = models.DateField(help_text="When this border ceases to exist")
     geo = models.GeometryField(blank=True)
+    encoded_geo = models.BinaryField(
+        null=True,
+        editable=False,
+        help_text="Geobuf encoding of geo, rebuilt whenever the territory is saved",
+    )
     entity = models.ForeignKey(
         Entity, related_name="territories", on_delete=models.CASCADE
     )
     references = ArrayField(models.TextField(max_length=150))
+    raw_vertex_count = models.PositiveIntegerField(
+        null=True,
+        editable=False,
+        help_text="Number of vertices of geo as it was submitted",
+    )
+    vertex_count = models.PositiveIntegerField(
+        null=True, editable=False, help_text="Number of vertices of geo once normalized"
+    )
     history = HistoricalRecords()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Territory, cls).from_db(db, field_names, values)
+        # Stored geometries were normalized when they were saved, unless they
+        # were saved before vertex counts were recorded
+        if instance.__dict__.get("vertex_count") is not None:
+            instance._normalized_geo = instance.__dict__.get("geo")
+        return instance
+
     def clean(self, *args, **kwargs):
         if self.start_date > self.end_date:
             raise ValidationError("Start date cannot be later than end date")
         if not self.geo is None:
-            if (
-                loads(self.geo.json)["type"] != "Polygon"
-                and loads(self.geo.json)["type"] != "MultiPolygon"
-            ):
+            if self.geo.geom_type not in ("Polygon", "MultiPolygon"):
                 raise ValidationError(
                     "Only Polygon and MultiPolygon objects are acceptable geometry types."
                 )
+            self.normalize()
+            if self.geo.empty:
+                raise ValidationError("The geometry has no area once normalized.")
 
         try:
             # This date check is inculsive.
             if (
-                Territory.objects.filter(
-                    start_date__lte=self.end_date,
-                    end_date__gte=self.start_date,
-                    entity__exact=self.entity,
-                )
+                Territory.objects.filter(entity__exact=self.entity)
+                .overlapping(self.start_date, self.end_date)
                 .exclude(pk__exact=self.pk)
                 .exists()
             ):
@@ -135,7 +189,64 @@ class Territory(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        super(Territory, self).save(*args, **kwargs)
+        self.encoded_geo = encode_geo(self.geo)
+        try:
+            with transaction.atomic():
+                super(Territory, self).save(*args, **kwargs)
+                # Simplifying detailed borders is slow, a worker rebuilds the
+                # levels and the full geometry is served until it is done
+                self.simplified.all().delete()
+                Job.objects.create(
+                    kind="simplify_territories", payload={"ids": [self.pk]}
+                )
+        except IntegrityError as error:
+            # A concurrent write got past clean, the exclusion constraint caught it
+            if (
+                getattr(error.__cause__, "pgcode", None)
+                != errorcodes.EXCLUSION_VIOLATION
+            ):
+                raise
+            raise ValidationError(
+                "Another territory of this PoliticalEntity exists during this timeframe."
+            )
+
+    def normalize(self):
+        """
+        Repairs and cleans up geo, and records its vertex count before and after
+        """
+        if self.geo is None or self.geo is getattr(self, "_normalized_geo", None):
+            return
+        self.raw_vertex_count = self.geo.num_coords
+        self.geo = normalize_geometry(self.geo)
+        self.vertex_count = self.geo.num_coords
+        self._normalized_geo = self.geo
+
+    def simplify(self):
+        """
+        Rebuilds the simplified geometries served to low zoom levels
+        """
+        self.simplified.all().delete()
+        SimplifiedGeometry.objects.bulk_create(self.build_simplified())
+
+    def build_simplified(self):
+        """
+        Returns the unsaved simplified geometries of every zoom level
+        """
+        if self.geo is None:
+            return []
+
+        simplified = []
+        for zoom in settings.TERRITORY_ZOOM_LEVELS:
+            geo = self.geo.simplify(zoom_tolerance(zoom), preserve_topology=True)
+            # Levels that drop no vertices are served the full geometry instead
+            if geo.num_coords >= self.geo.num_coords:
+                continue
+            simplified.append(
+                SimplifiedGeometry(
+                    territory=self, zoom=zoom, geo=geo, encoded_geo=encode_geo(geo)
+                )
+            )
+        return simplified
 
     def __str__(self):
         return "%s: %s - %s" % (
@@ -145,11 +256,34 @@ class Territory(models.Model):
         )
 
 
+class SimplifiedGeometry(models.Model):
+    """
+    Topology-preserving simplification of a Territory for a given zoom level
+    """
+
+    class Meta:
+        unique_together = ("territory", "zoom")
+
+    territory = models.ForeignKey(
+        Territory, related_name="simplified", on_delete=models.CASCADE
+    )
+    zoom = models.PositiveSmallIntegerField(
+        help_text="Web map zoom level this geometry was simplified for"
+    )
+    geo = models.GeometryField()
+    encoded_geo = models.BinaryField()
+
+    def __str__(self):
+        return "%s (zoom %d)" % (self.territory, self.zoom)
+
+
 class DiplomaticRelation(models.Model):
     """
     Defines political and diplomatic interactions between PoliticalEntitys.
     """
 
+    objects = PeriodQuerySet.as_manager()
+
     start_date = models.DateField(help_text="When this relation takes effect")
     end_date = models.DateField(help_text="When this relation ceases to exist")
     parent_parties = models.ManyToManyField(
@@ -194,3 +328,46 @@ class DiplomaticRelation(models.Model):
             self.start_date.strftime("%m/%d/%Y"),
             self.end_date.strftime("%m/%d/%Y"),
         )
+
+
+class Job(models.Model):
+    """
+    Background task queued by a request and run by the worker management command
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    kind = models.TextField(help_text="Name of the registered task to run")
+    payload = JSONField(help_text="Arguments passed to the task")
+    status = models.TextField(choices=STATUS_CHOICES, default=QUEUED)
+    result = JSONField(
+        null=True, blank=True, help_text="Return value, or errors of a failed task"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(
+        default=0, help_text="Number of times a worker claimed the job"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+            # Newest finished job of a kind, see TerritoryViewSet.latest_history
+            models.Index(fields=["kind", "finished"]),
+        ]
+
+    def __str__(self):
+        return "%s #%d (%s)" % (self.kind, self.pk, self.status)
@@ -0,0 +1,25 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on the primary key, every page is fetched with
+    WHERE id > last_id LIMIT page_size instead of an OFFSET scan.
+
+    Pagination only kicks in when a client asks for it with ?page_size= or
+    follows a ?cursor= link, so existing clients keep receiving plain lists.
+    """
+
+    ordering = "id"
+    page_size_query_param = "page_size"
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if (
+            self.cursor_query_param not in params
+            and self.page_size_query_param not in params
+        ):
+            return None
+        return super(KeysetPagination, self).paginate_queryset(queryset, request, view)
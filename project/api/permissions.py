@@ -1,14 +1,11 @@
 import jwt
-import json
-import re
 
 from django.http import JsonResponse
 from django.conf import settings
 from rest_framework import permissions
 from functools import wraps
-from six.moves.urllib import request as req
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.backends import default_backend
+
+from .jwks import signing_key
 
 
 class IsStaffOrSpecificUser(permissions.BasePermission):
@@ -51,21 +48,9 @@ def requires_scope(required_scope):
         @wraps(f)
         def decorated(*args, **kwargs):
             token = get_token_auth_header(args[0])
-            jsonurl = req.urlopen(
-                "https://" + settings.AUTH0_DOMAIN + "/.well-known/jwks.json"
-            )
-            jwks = json.loads(jsonurl.read())
-            body = re.sub("(.{64})", "\\1\n", jwks["keys"][0]["x5c"][0], 0, re.DOTALL)
-            cert = (
-                "-----BEGIN CERTIFICATE-----\n" + body + "\n-----END CERTIFICATE-----"
-            )
-            certificate = load_pem_x509_certificate(
-                cert.encode("utf-8"), default_backend()
-            )
-            public_key = certificate.public_key()
             decoded = jwt.decode(
                 token,
-                public_key,
+                signing_key(token),
                 audience=settings.API_IDENTIFIER,
                 algorithms=["RS256"],
             )
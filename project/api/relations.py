@@ -0,0 +1,86 @@
+"""
+Transitive traversal of diplomatic relations with a recursive CTE over the
+parent and child party tables
+"""
+from django.db import connection
+
+from .models import DiplomaticRelation, PoliticalEntity
+
+PARENTS = DiplomaticRelation._meta.get_field("parent_parties")
+CHILDREN = DiplomaticRelation._meta.get_field("child_parties")
+
+# Edges go from a source party to a target party of the same relation, parents
+# to children or the other way around when walking up. Both terms start from the
+# party tables so every step is a lookup on their index leading with the entity,
+# instead of a scan of every edge. UNION drops repeated rows, and the depth limit
+# stops the walk on cycles.
+RELATIONS_SQL = """
+WITH RECURSIVE walk(source, target, relation, diplo_type, depth) AS (
+    SELECT source.{party}, target.{party}, relation.id, relation.diplo_type, 1
+    FROM {sources} source
+    JOIN {relation} relation ON relation.id = source.{relation_column}
+    JOIN {targets} target ON target.{relation_column} = relation.id
+    WHERE source.{party} = %(root)s{filters}
+    UNION
+    SELECT source.{party}, target.{party}, relation.id, relation.diplo_type,
+        walk.depth + 1
+    FROM walk
+    JOIN {sources} source ON source.{party} = walk.target
+    JOIN {relation} relation ON relation.id = source.{relation_column}
+    JOIN {targets} target ON target.{relation_column} = relation.id
+    WHERE walk.depth < %(depth)s{filters}
+)
+SELECT source, target, relation, diplo_type, MIN(depth)
+FROM walk
+GROUP BY source, target, relation, diplo_type
+ORDER BY MIN(depth), relation
+"""
+
+DATE_FILTER = """
+        AND daterange(relation.start_date, relation.end_date, '[]') @> %(date)s::date"""
+TYPES_FILTER = """
+        AND relation.diplo_type = ANY(%(types)s)"""
+
+
+def relation_graph(root, depth, date=None, types=None, up=False):
+    """
+    Returns the entities reachable from root through at most depth relations
+    (active on date and of the given types) as a {"nodes": ..., "edges": ...}
+    graph. Relations are followed from parent to child, or from child to parent
+    when up is set.
+    """
+    parents = PARENTS.remote_field.through._meta.db_table
+    children = CHILDREN.remote_field.through._meta.db_table
+    sql = RELATIONS_SQL.format(
+        relation=DiplomaticRelation._meta.db_table,
+        sources=children if up else parents,
+        targets=parents if up else children,
+        relation_column=PARENTS.m2m_column_name(),
+        party=PARENTS.m2m_reverse_name(),
+        filters=(DATE_FILTER if date is not None else "")
+        + (TYPES_FILTER if types else ""),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql,
+            {"root": root, "depth": depth, "date": date, "types": list(types or [])},
+        )
+        edges = [
+            {
+                "source": source,
+                "target": target,
+                "relation": relation,
+                "diplo_type": diplo_type,
+                "depth": edge_depth,
+            }
+            for source, target, relation, diplo_type, edge_depth in cursor.fetchall()
+        ]
+
+    ids = {root} | {edge["target"] for edge in edges}
+    nodes = (
+        PoliticalEntity.objects.non_polymorphic()
+        .filter(pk__in=ids)
+        .order_by("id")
+        .values("id", "url_id", "name", "color")
+    )
+    return {"nodes": list(nodes), "edges": edges}
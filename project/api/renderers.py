@@ -0,0 +1,96 @@
+import json
+
+import geobuf
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def as_feature(item):
+    """
+    Converts a serialized territory to a GeoJSON Feature, geo must be GeoJSON
+    """
+    properties = {
+        key: value for key, value in item.items() if key != "geo" and value is not None
+    }
+    return {
+        "type": "Feature",
+        "id": item.get("id"),
+        "geometry": item.get("geo"),
+        "properties": properties,
+    }
+
+
+class GeobufRenderer(BaseRenderer):
+    """
+    Renders serialized territories as a single geobuf encoded FeatureCollection,
+    with every attribute but geo stored as a feature property
+    """
+
+    media_type = "application/x-protobuf"
+    format = "geobuf"
+    charset = None
+    render_style = "binary"
+    geojson_geometry = True
+    # geobuf cannot encode features without a geometry
+    required_fields = ("geo",)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        collection = {"type": "FeatureCollection", "features": []}
+        response = (renderer_context or {}).get("response")
+        if response is not None and response.status_code >= 400:
+            # Error responses are sent as properties of an empty collection
+            collection.update(data)
+            return geobuf.encode(collection)
+
+        if isinstance(data, dict) and "results" in data:
+            # Paginated responses keep their links as collection properties
+            collection.update(
+                {
+                    key: value
+                    for key, value in data.items()
+                    if key != "results" and value is not None
+                }
+            )
+            data = data["results"]
+
+        for item in [data] if isinstance(data, dict) else data:
+            collection["features"].append(as_feature(item))
+        return geobuf.encode(collection)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders one JSON document per line, lines can be streamed one at a time
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+    geojson_geometry = False
+
+    def render_item(self, item):
+        return json.dumps(item, cls=JSONEncoder).encode("utf-8") + b"\n"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        items = [data] if isinstance(data, dict) else data
+        return b"".join(self.render_item(item) for item in items)
+
+
+class GeoJSONSeqRenderer(NDJSONRenderer):
+    """
+    Renders territories as RFC 8142 GeoJSON text sequences of Features
+    """
+
+    media_type = "application/geo+json-seq"
+    format = "geojsonseq"
+    geojson_geometry = True
+
+    def render_item(self, item):
+        if "geo" in item:
+            item = as_feature(item)
+        return b"\x1e" + super(GeoJSONSeqRenderer, self).render_item(item)
@@ -0,0 +1,71 @@
+"""
+Cache of the serialized data of read responses, keyed on normalized query
+parameters. Every cached resource has a generation number that is part of its
+keys, so invalidating it is a single increment no matter how many responses
+were cached.
+"""
+from hashlib import md5
+from time import time
+
+from django.core.cache import caches
+
+CACHE_ALIAS = "responses"
+
+
+def response_cache():
+    return caches[CACHE_ALIAS]
+
+
+def generation(resource):
+    key = "responses:%s:generation" % resource
+    version = response_cache().get(key)
+    if version is None:
+        # A fresh version makes sure no key of a dropped generation is reused
+        version = int(time() * 1000000)
+        response_cache().set(key, version, None)
+    return version
+
+
+def response_key(resource, params):
+    """
+    Returns the key of a response, params must have a stable repr
+    """
+    digest = md5(repr(params).encode("utf-8")).hexdigest()
+    return "responses:%s:%s:%s" % (resource, generation(resource), digest)
+
+
+def invalidate(*resources):
+    for resource in resources:
+        try:
+            response_cache().incr("responses:%s:generation" % resource)
+        except ValueError:
+            # Nothing was cached yet
+            pass
+
+
+def count(resource, outcome):
+    key = "responses:%s:%s" % (resource, outcome)
+    try:
+        response_cache().incr(key)
+    except ValueError:
+        response_cache().set(key, 1, None)
+
+
+def stats(resources):
+    """
+    Returns the hit and miss counters of each resource
+    """
+    counters = response_cache().get_many(
+        [
+            "responses:%s:%s" % (resource, outcome)
+            for resource in resources
+            for outcome in ("hits", "misses")
+        ]
+    )
+    return {
+        resource: {
+            outcome: counters.get("responses:%s:%s" % (resource, outcome), 0)
+            for outcome in ("hits", "misses")
+        }
+        for resource in resources
+    }
@@ -0,0 +1,51 @@
+"""
+Ranked search of political entities by name, alias and description, answered by
+the trigram and full-text indexes created in migration 0012
+"""
+from django.db import connection
+
+from .models import Entity, PoliticalEntity, Territory
+
+# word_similarity (<%) matches the query against any part of a name, which is
+# what autocompletion needs. The expressions must match the indexed ones.
+SEARCH_SQL = """
+SELECT entity.id
+FROM {entity} entity
+JOIN {political} political ON political.entity_ptr_id = entity.id
+WHERE (
+    %(q)s <%% entity.name
+    OR %(q)s <%% api_entity_aliases_text(entity.aliases)
+    OR to_tsvector('english', entity.description) @@ plainto_tsquery('english', %(q)s)
+){date_filter}
+ORDER BY GREATEST(
+    word_similarity(%(q)s, entity.name),
+    word_similarity(%(q)s, api_entity_aliases_text(entity.aliases)),
+    ts_rank(to_tsvector('english', entity.description), plainto_tsquery('english', %(q)s))
+) DESC, entity.id
+LIMIT %(limit)s
+"""
+
+# Served by the index of the exclusion constraint on (entity_id, period)
+DATE_FILTER = """
+AND EXISTS (
+    SELECT 1 FROM {territory} territory
+    WHERE territory.entity_id = entity.id
+        AND daterange(territory.start_date, territory.end_date, '[]') @> %(date)s::date
+)"""
+
+
+def search_entities(q, limit, date=None):
+    """
+    Returns the ids of the best matching political entities, best first. With a
+    date, only entities with a territory on that date are returned.
+    """
+    sql = SEARCH_SQL.format(
+        entity=Entity._meta.db_table,
+        political=PoliticalEntity._meta.db_table,
+        date_filter=DATE_FILTER.format(territory=Territory._meta.db_table)
+        if date is not None
+        else "",
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"q": q, "limit": limit, "date": date})
+        return [row[0] for row in cursor.fetchall()]
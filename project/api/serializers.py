@@ -1,12 +1,55 @@
-from json import loads, dumps
+from base64 import b64encode
+from json import loads
 
-from django.contrib.gis.geos import GEOSGeometry
 from rest_framework import serializers
-import geobuf
-from .models import PoliticalEntity, Territory, DiplomaticRelation
+from .geo import encode_geo, geometry_from_geojson
+from .models import PoliticalEntity, Territory, DiplomaticRelation, Job
 
 
-class PoliticalEntitySerializer(serializers.ModelSerializer):
+def param_list(request, name):
+    return {value for value in request.query_params.get(name, "").split(",") if value}
+
+
+class SparseFieldsMixin:
+    """
+    Leaves the fields not listed in ?fields=a,b, or listed in ?omit=a,b, out
+    of read responses
+    """
+
+    # Model fields read by the serializer fields whose source is the instance
+    instance_sources = {}
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method not in ("GET", "HEAD"):
+            return
+
+        fields = param_list(request, "fields")
+        omit = param_list(request, "omit")
+        # Some renderers cannot do without some fields
+        renderer = getattr(request, "accepted_renderer", None)
+        required = getattr(renderer, "required_fields", ())
+        for name in list(self.fields):
+            if name in required:
+                continue
+            if (fields and name not in fields) or name in omit:
+                self.fields.pop(name)
+
+    def model_fields(self):
+        """
+        Returns the names of the model fields the remaining fields are read from
+        """
+        names = set()
+        for name, field in self.fields.items():
+            if field.source == "*":
+                names.update(self.instance_sources.get(name, ()))
+            else:
+                names.add(field.source.split(".")[0])
+        return names
+
+
+class PoliticalEntitySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializes the PoliticalEntity model
     """
@@ -19,23 +62,51 @@ class PoliticalEntitySerializer(serializers.ModelSerializer):
 class GeoField(serializers.RelatedField):
     """
     Field Serializer for Territories
+
+    Geometries are sent as hexadecimal geobuf, or base64 geobuf with
+    ?geo_encoding=base64. Renderers that build GeoJSON Features themselves
+    (such as the geobuf renderer) are given plain GeoJSON instead.
     """
 
-    @classmethod
     def to_representation(self, value):
-        # Compress geojson to geobuf and return as hexadecimal
-        gbuf = geobuf.encode(loads(value.geojson))
-        return gbuf.hex()
-
-
-class TerritorySerializer(serializers.ModelSerializer):
+        # Use the simplified geometry prefetched by the zoom filter if there is one
+        simplified = getattr(value, "simplified_geo", None)
+        if simplified:
+            value = simplified[0]
+
+        request = self.context.get("request")
+        renderer = getattr(request, "accepted_renderer", None)
+        if getattr(renderer, "geojson_geometry", False):
+            return loads(value.geo.geojson)
+
+        # Serve the geobuf stored on save, only encoding rows saved before it existed
+        gbuf = value.encoded_geo
+        if gbuf is None:
+            gbuf = encode_geo(value.geo)
+        if request is not None and request.query_params.get("geo_encoding") == "base64":
+            return b64encode(gbuf).decode("ascii")
+        return bytes(gbuf).hex()
+
+
+class TerritorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializes the Territory model as GeoJSON compatible data
     """
 
     entity = serializers.SlugRelatedField(read_only=True, slug_field="url_id")
 
-    geo = GeoField(read_only=True)
+    geo = GeoField(source="*", read_only=True)
+
+    instance_sources = {"geo": ("geo", "encoded_geo")}
+
+    def model_fields(self):
+        names = super(TerritorySerializer, self).model_fields()
+        request = self.context.get("request")
+        renderer = getattr(request, "accepted_renderer", None)
+        if "geo" in self.fields and not getattr(renderer, "geojson_geometry", False):
+            # The stored geobuf is served, geo is only loaded for rows without one
+            names.discard("geo")
+        return names
 
     def to_internal_value(self, data):
         ret = {}
@@ -43,35 +114,27 @@ class TerritorySerializer(serializers.ModelSerializer):
         # Update ret to include passed in data
         for field, val in data.items():
             if field == "entity":
-                ret["entity"] = PoliticalEntity.objects.get(pk=val)
+                ret["entity"] = PoliticalEntity.objects.non_polymorphic().get(pk=val)
             if field != "geo" and field != "entity":
                 ret[field] = val
 
         # Convert geo field to MultiPolygon if it is a FeatureCollection
-        geojson = loads(data["geo"])
-        if geojson["type"] == "FeatureCollection":
-            features = geojson["features"]
-            features_union = GEOSGeometry(dumps(features[0]["geometry"]))
-            features = features[1:]
-
-            for feature in features:
-                if feature["geometry"]["type"] == "Polygon":
-                    features_union = features_union.union(
-                        GEOSGeometry(dumps(feature["geometry"]))
-                    )
-
-            ret["geo"] = features_union
-        else:
-            ret["geo"] = data["geo"]
+        ret["geo"] = geometry_from_geojson(data["geo"])
+        if ret["geo"] is None:
+            raise serializers.ValidationError(
+                {
+                    "geo": "The FeatureCollection has no Polygon or MultiPolygon features."
+                }
+            )
 
         return ret
 
     class Meta:
         model = Territory
-        fields = "__all__"
+        exclude = ("encoded_geo",)
 
 
-class DiplomaticRelationSerializer(serializers.ModelSerializer):
+class DiplomaticRelationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Serializes the DiplomaticRelation model
     """
@@ -81,3 +144,18 @@ class DiplomaticRelationSerializer(serializers.ModelSerializer):
     class Meta:
         model = DiplomaticRelation
         fields = "__all__"
+        # Parties are only looked up by pk, their real class is not needed
+        extra_kwargs = {
+            "parent_parties": {"queryset": PoliticalEntity.objects.non_polymorphic()},
+            "child_parties": {"queryset": PoliticalEntity.objects.non_polymorphic()},
+        }
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """
+    Serializes the status of a Job, without its payload
+    """
+
+    class Meta:
+        model = Job
+        exclude = ("payload", "user")
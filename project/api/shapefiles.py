@@ -0,0 +1,111 @@
+"""
+Reads zipped shapefiles straight from memory through GDAL's virtual file systems,
+without extracting them to disk
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from ctypes import byref, c_buffer
+from uuid import uuid4
+from zipfile import BadZipFile, ZipFile
+from io import BytesIO
+
+from django.contrib.gis import gdal, geos
+from django.contrib.gis.gdal.prototypes import raster as capi
+from django.contrib.gis.gdal.raster.const import (
+    VSI_FILESYSTEM_BASE_PATH,
+    VSI_TAKE_BUFFER_OWNERSHIP,
+)
+from django.utils.encoding import force_bytes
+
+
+class ShapefileError(Exception):
+    pass
+
+
+@contextmanager
+def vsi_zip(data):
+    """
+    Exposes a zip archive held in memory as a /vsizip/ path, removed on exit
+    """
+    path = VSI_FILESYSTEM_BASE_PATH + "%s.zip" % uuid4()
+    # GDAL reads the buffer in place, it must stay referenced until unlinked
+    buffer = c_buffer(data, len(data))
+    capi.create_vsi_file_from_mem_buffer(
+        force_bytes(path), byref(buffer), len(data), VSI_TAKE_BUFFER_OWNERSHIP
+    )
+    try:
+        yield "/vsizip/" + path
+    finally:
+        capi.unlink_vsi_file(force_bytes(path))
+
+
+def shapefile_members(data):
+    """
+    Returns the paths of the .shp files of a zip archive
+    """
+    try:
+        names = ZipFile(BytesIO(data)).namelist()
+    except BadZipFile:
+        raise ShapefileError("Could not read zipfile.")
+    members = [name for name in names if name.lower().endswith(".shp")]
+    if not members:
+        raise ShapefileError("The zipfile does not contain a shapefile.")
+    return members
+
+
+def layer_polygons(path):
+    """
+    Returns the polygons of every layer of the shapefile at path as WKB, in
+    WGS84 and with MultiPolygons split into their parts
+    """
+    polygons = []
+    for layer in gdal.DataSource(path):
+        for feature in layer:
+            geom = feature.geom
+            if geom.srs is not None and geom.srid != 4326:
+                geom.transform(4326)
+            geom = geom.geos
+            if isinstance(geom, geos.Polygon):
+                polygons.append(bytes(geom.wkb))
+            elif isinstance(geom, geos.MultiPolygon):
+                polygons.extend(bytes(polygon.wkb) for polygon in geom)
+    return polygons
+
+
+def read_polygons(data, member):
+    """
+    Returns the polygons of one shapefile of the archive, see layer_polygons
+    """
+    with vsi_zip(data) as root:
+        # The data source is released on return, before its file is unlinked
+        return layer_polygons("%s/%s" % (root, member))
+
+
+def read_shapefile(data, workers=0):
+    """
+    Merges the polygons of every shapefile in a zip archive into a single
+    MultiPolygon with a cascaded union, or returns None if there are none.
+    With workers, the shapefiles are read by that many processes.
+    """
+    members = shapefile_members(data)
+    try:
+        if workers and len(members) > 1:
+            # The workers never touch the database, so the connection of the
+            # forking request can be left alone
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(read_polygons, [data] * len(members), members)
+                )
+        else:
+            results = [read_polygons(data, member) for member in members]
+    except (gdal.GDALException, geos.GEOSException):
+        raise ShapefileError("Error converting shapefile")
+
+    polygons = [geos.GEOSGeometry(memoryview(wkb)) for wkbs in results for wkb in wkbs]
+    if not polygons:
+        return None
+
+    union = geos.MultiPolygon(polygons, srid=4326).unary_union
+    if isinstance(union, geos.Polygon):
+        union = geos.MultiPolygon(union, srid=4326)
+    return union
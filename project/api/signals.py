@@ -0,0 +1,119 @@
+"""
+Receivers keeping the derived caches consistent with model writes.
+
+Caches are invalidated once the write is committed: a request reading the old
+rows after an earlier invalidation would cache them under the new generation.
+What the invalidations need is gathered when the signal is sent, as deleted
+rows are gone by then.
+"""
+from django.contrib.gis.db.models import Extent
+from django.db import transaction
+from django.db.models.signals import (
+    pre_save,
+    post_save,
+    pre_delete,
+    post_delete,
+    m2m_changed,
+)
+from django.dispatch import receiver
+
+from . import response_cache
+from .epochs import invalidate_all, invalidate_periods
+from .geo import geo_extent
+from .models import DiplomaticRelation, Entity, PoliticalEntity, Territory
+from .tiles import invalidate_tiles
+
+
+def after_commit(function, *args):
+    """
+    Calls function with args once the current transaction is committed, right
+    away outside of one
+    """
+    transaction.on_commit(lambda: function(*args))
+
+
+@receiver(pre_save, sender=Territory)
+def remember_previous_territory(sender, instance, **kwargs):
+    # Keep the stored geometry and period around so the caches they were part
+    # of can be cleared once the territory changes
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = (
+            Territory.objects.filter(pk=instance.pk)
+            .values("geo", "start_date", "end_date")
+            .first()
+        )
+
+
+@receiver(post_save, sender=Territory)
+def territory_saved(sender, instance, **kwargs):
+    previous = getattr(instance, "_previous", None) or {
+        "geo": None,
+        "start_date": None,
+        "end_date": None,
+    }
+    after_commit(
+        invalidate_tiles, [geo_extent(previous["geo"]), geo_extent(instance.geo)]
+    )
+    after_commit(
+        invalidate_periods,
+        [
+            (previous["start_date"], previous["end_date"]),
+            (instance.start_date, instance.end_date),
+        ],
+    )
+
+
+@receiver(post_delete, sender=Territory)
+def territory_deleted(sender, instance, **kwargs):
+    after_commit(invalidate_tiles, [geo_extent(instance.geo)])
+    after_commit(invalidate_periods, [(instance.start_date, instance.end_date)])
+
+
+def entity_extent(entity):
+    """
+    Returns the extent of every territory of an entity, None if it has none
+    """
+    return Territory.objects.filter(entity_id=entity.pk).aggregate(
+        extent=Extent("geo")
+    )["extent"]
+
+
+@receiver(post_save, sender=Entity)
+@receiver(post_save, sender=PoliticalEntity)
+def entity_saved(sender, instance, **kwargs):
+    # Snapshots embed entity url_ids, and tiles url_ids and colors
+    after_commit(invalidate_all)
+    after_commit(invalidate_tiles, [entity_extent(instance)])
+
+
+@receiver(pre_delete, sender=Entity)
+@receiver(pre_delete, sender=PoliticalEntity)
+def entity_deleted(sender, instance, **kwargs):
+    # Territories are deleted along with their entity, find them while they exist
+    after_commit(invalidate_tiles, [entity_extent(instance)])
+
+
+@receiver(post_save, sender=Territory)
+@receiver(post_delete, sender=Territory)
+def territory_changed(sender, **kwargs):
+    after_commit(response_cache.invalidate, "territories")
+
+
+@receiver(post_save, sender=Entity)
+@receiver(post_save, sender=PoliticalEntity)
+@receiver(post_delete, sender=Entity)
+@receiver(post_delete, sender=PoliticalEntity)
+def entity_changed(sender, **kwargs):
+    # Territories embed entity url_ids and relations list their parties
+    after_commit(
+        response_cache.invalidate, "politicalentities", "territories", "diprels"
+    )
+
+
+@receiver(post_save, sender=DiplomaticRelation)
+@receiver(post_delete, sender=DiplomaticRelation)
+@receiver(m2m_changed, sender=DiplomaticRelation.parent_parties.through)
+@receiver(m2m_changed, sender=DiplomaticRelation.child_parties.through)
+def diprel_changed(sender, **kwargs):
+    after_commit(response_cache.invalidate, "diprels")
@@ -1,15 +1,43 @@
+import base64
 import json
+from datetime import date, timedelta
+from io import BytesIO
+from itertools import accumulate
+import os
 import requests
+import shutil
+import struct
+from tempfile import gettempdir, mkdtemp, mkstemp
+from unittest import mock
+from zipfile import ZipFile
 
 from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.urls import reverse
-from django.contrib.gis.geos import GEOSGeometry
-from django.test import TestCase
+from django.contrib.gis.gdal import SpatialReference
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Point
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
 from django.core.exceptions import ValidationError
 from rest_framework import status
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 import geobuf
-from rest_framework.test import APITestCase
-from .models import PoliticalEntity, Territory, DiplomaticRelation
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from .models import PoliticalEntity, Territory, DiplomaticRelation, Job
+from .epochs import get_snapshot, invalidate_all, invalidate_periods
+from .forms import TerritoryForm
+from .geo import snap
+from .jobs import JOB_LOCK_SPACE, run_next
+from .views import PoliticalEntityViewSet, TerritoryViewSet
+from .response_cache import stats
+from .jwks import FileSource, PEMFileSource, KeyCache, SigningKeyNotFound
 from .factories import (
     PoliticalEntityFactory,
     TerritoryFactory,
@@ -49,7 +77,117 @@ def getUserToken(
     return response["access_token"]
 
 
+def shapefile(records):
+    """
+    Returns the .shp, .shx and .dbf contents of a polygon shapefile. Records are
+    lists of rings, clockwise for outer rings and counterclockwise for holes.
+    """
+    contents = []
+    for rings in records:
+        points = [point for ring in rings for point in ring]
+        box = (
+            min(x for x, _ in points),
+            min(y for _, y in points),
+            max(x for x, _ in points),
+            max(y for _, y in points),
+        )
+        parts = list(accumulate([0] + [len(ring) for ring in rings[:-1]]))
+        contents.append(
+            struct.pack("<i4d2i", 5, *box, len(rings), len(points))
+            + struct.pack("<%di" % len(parts), *parts)
+            + b"".join(struct.pack("<2d", x, y) for x, y in points)
+        )
+    points = [point for rings in records for ring in rings for point in ring]
+    box = (
+        min(x for x, _ in points),
+        min(y for _, y in points),
+        max(x for x, _ in points),
+        max(y for _, y in points),
+    )
+
+    def header(size):
+        return struct.pack(">7i", 9994, 0, 0, 0, 0, 0, size // 2) + struct.pack(
+            "<2i8d", 1000, 5, *box, 0, 0, 0, 0
+        )
+
+    shp = b"".join(
+        struct.pack(">2i", number, len(content) // 2) + content
+        for number, content in enumerate(contents, 1)
+    )
+    shx = b""
+    offset = 100
+    for content in contents:
+        shx += struct.pack(">2i", offset // 2, len(content) // 2)
+        offset += 8 + len(content)
+    dbf = (
+        struct.pack("<B3BIHH20x", 3, 118, 1, 1, len(records), 65, 11)
+        + struct.pack("<11sc4xBB14x", b"id", b"N", 10, 0)
+        + b"\r"
+        + b"".join(
+            b" " + str(index).rjust(10).encode() for index in range(len(records))
+        )
+        + b"\x1a"
+    )
+    return header(100 + len(shp)) + shp, header(100 + len(shx)) + shx, dbf
+
+
+def square(xmin, ymin, xmax, ymax):
+    """
+    Clockwise ring, the orientation of shapefile outer rings
+    """
+    return [(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]
+
+
+def shapefile_zip(members):
+    """
+    Zips the shapefiles of {name: (records, prj)}, see shapefile
+    """
+    archive = BytesIO()
+    with ZipFile(archive, "w") as zipped:
+        for name, (records, prj) in members.items():
+            for extension, content in zip(("shp", "shx", "dbf"), shapefile(records)):
+                zipped.writestr("%s.%s" % (name, extension), content)
+            if prj is not None:
+                zipped.writestr("%s.prj" % name, prj)
+    return archive.getvalue()
+
+
+def run_jobs():
+    """
+    Runs every queued job, as the worker command would
+    """
+    while run_next() is not None:
+        pass
+
+
+# Tests may run next to a live server (make exec_test), keep their cached data
+# and tiles out of its caches
+isolated_caches = override_settings(
+    CACHES={
+        alias: {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "test-%s" % alias,
+        }
+        for alias in settings.CACHES
+    },
+    TILE_CACHE_DIR=os.path.join(gettempdir(), "chronoscio-test-tiles"),
+)
+
+# Test transactions are rolled back instead of committed, run the caches
+# invalidations registered with transaction.on_commit right away
+commit_immediately = mock.patch(
+    "django.db.transaction.on_commit", lambda func, using=None: func()
+)
+
+
+@isolated_caches
+@commit_immediately
 class ModelTest(TestCase):
+    def setUp(self):
+        # Cached data outlives the rolled back test transactions
+        for alias in settings.CACHES:
+            caches[alias].clear()
+
     @classmethod
     def setUpTestData(cls):
         """
@@ -186,8 +324,165 @@ class ModelTest(TestCase):
                 ),
             )
 
+    def test_model_can_query_territories_by_period(self):
+        """
+        Ensure the range lookups include both the start and end dates
+        """
+        self.assertTrue(Territory.objects.active_on(date(2, 1, 1)).exists())
+        self.assertTrue(Territory.objects.active_on(date(4, 1, 1)).exists())
+        self.assertFalse(Territory.objects.active_on(date(4, 1, 2)).exists())
+        self.assertTrue(
+            Territory.objects.overlapping("0004-01-01", "0006-01-01").exists()
+        )
+        self.assertFalse(
+            Territory.objects.overlapping("0004-01-02", "0006-01-01").exists()
+        )
 
+    def test_model_drops_snapshots_built_during_a_change(self):
+        """
+        Ensure a snapshot built while its epoch is invalidated is never served
+        """
+        day = date(2, 6, 1)
+
+        def build_during_change():
+            invalidate_periods([(day, day)])
+            return "stale"
+
+        self.assertEqual(get_snapshot(day, "hex", build_during_change), "stale")
+        self.assertEqual(get_snapshot(day, "hex", lambda: "fresh"), "fresh")
+        self.assertEqual(get_snapshot(day, "hex", lambda: "rebuilt"), "fresh")
+
+    def test_model_invalidates_after_commit(self):
+        """
+        Ensure cached snapshots are only dropped once a change is committed
+        """
+        day = date(2, 6, 1)
+        get_snapshot(day, "hex", lambda: "before")
+        callbacks = []
+        with mock.patch("django.db.transaction.on_commit", callbacks.append):
+            territory = Territory.objects.get(pk=self.territory.pk)
+            territory.references = ["https://en.wikipedia.org/wiki/Changed"]
+            territory.save()
+        self.assertEqual(get_snapshot(day, "hex", lambda: "rebuilt"), "before")
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_snapshot(day, "hex", lambda: "rebuilt"), "rebuilt")
+
+    def test_model_drops_every_snapshot(self):
+        """
+        Ensure invalidate_all drops the snapshots of every epoch
+        """
+        first, last = date(1, 1, 1), date(8, 1, 1)
+        get_snapshot(first, "hex", lambda: "first")
+        get_snapshot(last, "hex", lambda: "last")
+        invalidate_all()
+        self.assertEqual(get_snapshot(first, "hex", lambda: "rebuilt"), "rebuilt")
+        self.assertEqual(get_snapshot(last, "hex", lambda: "rebuilt"), "rebuilt")
+
+    def test_model_stores_encoded_geo(self):
+        """
+        Ensure the geobuf payload is rebuilt whenever a territory is saved
+        """
+        territory = Territory.objects.get(pk=self.territory.pk)
+        self.assertEqual(
+            bytes(territory.encoded_geo),
+            geobuf.encode(json.loads(territory.geo.geojson)),
+        )
+        territory.geo = GEOSGeometry(
+            '{"type": "Polygon","coordinates": [[ [100.0, 0.0], [101.0, 0.0], [101.0, 1.0], [100.0, 1.0], [100.0, 0.0] ]]}'
+        )
+        territory.save()
+        territory.refresh_from_db()
+        self.assertEqual(geobuf.decode(bytes(territory.encoded_geo))["type"], "Polygon")
+        self.assertEqual(
+            bytes(territory.history.first().encoded_geo), bytes(territory.encoded_geo)
+        )
+
+    def test_model_snaps_without_float_noise(self):
+        """
+        Ensure snapped coordinates keep no more decimals than the grid
+        """
+        self.assertEqual(
+            snap([(12.3456789, 0.1000001), (-0.30000004, 1e-9)], 0.000001),
+            [(12.345679, 0.1), (-0.3, 0.0)],
+        )
+
+    @override_settings(GEOMETRY_GRID_SIZE=0.5)
+    def test_model_normalizes_geo(self):
+        """
+        Ensure saved geometries are snapped, cleaned up, oriented and repaired
+        """
+        territory = Territory.objects.create(
+            start_date="0002-01-01",
+            end_date="0004-01-01",
+            entity=self.child_nation,
+            references=["https://en.wikipedia.org/wiki/Test"],
+            # Clockwise, with a repeated, a collinear and an off grid vertex
+            geo=GEOSGeometry(
+                '{"type": "Polygon","coordinates": [[ [100.0, 0.0], [100.0, 1.0], [101.1, 1.0], [101.0, 0.5], [101.0, 0.0], [101.0, 0.0], [100.0, 0.0] ]]}'
+            ),
+        )
+        self.assertEqual(
+            territory.geo.coords,
+            (((100.0, 0.0), (101.0, 0.0), (101.0, 1.0), (100.0, 1.0), (100.0, 0.0)),),
+        )
+        self.assertEqual(territory.raw_vertex_count, 7)
+        self.assertEqual(territory.vertex_count, 5)
+        self.assertEqual(territory.history.first().vertex_count, 5)
+
+        # Overlapping polygons are merged into a valid MultiPolygon
+        territory.geo = GEOSGeometry(
+            '{"type": "MultiPolygon","coordinates": [[[ [100.0, 0.0], [101.0, 0.0], [101.0, 1.0], [100.0, 1.0], [100.0, 0.0] ]],[[ [100.5, 0.0], [101.5, 0.0], [101.5, 1.0], [100.5, 1.0], [100.5, 0.0] ]]]}'
+        )
+        territory.save()
+        self.assertTrue(territory.geo.valid)
+        self.assertEqual(territory.geo.geom_type, "MultiPolygon")
+        self.assertEqual(len(territory.geo), 1)
+        self.assertAlmostEqual(territory.geo.area, 1.5)
+        self.assertEqual(territory.vertex_count, 5)
+
+        # Self-intersecting rings keep both of their lobes
+        territory.geo = GEOSGeometry(
+            '{"type": "Polygon","coordinates": [[ [100.0, 0.0], [101.0, 1.0], [101.0, 0.0], [100.0, 1.0], [100.0, 0.0] ]]}'
+        )
+        territory.save()
+        self.assertTrue(territory.geo.valid)
+        self.assertEqual(territory.geo.geom_type, "MultiPolygon")
+        self.assertEqual(len(territory.geo), 2)
+        self.assertAlmostEqual(territory.geo.area, 0.5)
+
+    @override_settings(GEOMETRY_GRID_SIZE=0.5)
+    def test_model_normalizes_legacy_geo(self):
+        """
+        Ensure geometries stored before they were normalized are normalized
+        when they are saved again
+        """
+        # Clockwise and off grid, as rows saved before vertex counts existed
+        Territory.objects.filter(pk=self.territory.pk).update(
+            geo=GEOSGeometry(
+                '{"type": "Polygon","coordinates": [[ [100.0, 0.0], [100.0, 1.0], [101.1, 1.0], [101.0, 0.0], [100.0, 0.0] ]]}'
+            ),
+            vertex_count=None,
+        )
+        territory = Territory.objects.get(pk=self.territory.pk)
+        territory.save()
+        self.assertEqual(
+            territory.geo.coords,
+            (((100.0, 0.0), (101.0, 0.0), (101.0, 1.0), (100.0, 1.0), (100.0, 0.0)),),
+        )
+        self.assertEqual(territory.vertex_count, 5)
+
+
+@isolated_caches
+@commit_immediately
+@override_settings(QUERY_BUDGET_STRICT=True)
 class APITest(APITestCase):
+    def setUp(self):
+        # Cached data outlives the rolled back test transactions
+        for alias in settings.CACHES:
+            caches[alias].clear()
+
     @classmethod
     def setUpTestData(cls):
         """
@@ -235,6 +530,8 @@ class APITest(APITestCase):
         )
         cls.diprel.parent_parties.add(cls.new_nation)
         cls.diprel.child_parties.add(cls.child_nation)
+        # Start every test with an empty queue
+        run_jobs()
 
     def test_api_can_create_PoliticalEntity(self):
         """
@@ -274,6 +571,26 @@ class APITest(APITestCase):
         self.assertEqual(Territory.objects.count(), 3)
         self.assertEqual(Territory.objects.last().entity, self.new_nation)
 
+    def test_api_can_create_territory_FC_multipolygon(self):
+        """
+        Ensure FeatureCollections are merged with their MultiPolygon features
+        """
+        url = reverse("territory-list")
+        data = {
+            "start_date": "0008-01-01",
+            "end_date": "0009-01-01",
+            "entity": self.new_nation.id,
+            "references": ["https://en.wikipedia.org/wiki/Test"],
+            "geo": '{"type": "FeatureCollection","features": [{"type": "Feature","properties": {},"geometry": {"type": "Polygon","coordinates": [[[100,0],[101,0],[101,1],[100,1],[100,0]]]}},{"type": "Feature","properties": {},"geometry": {"type": "MultiPolygon","coordinates": [[[[100.5,0],[102,0],[102,1],[100.5,1],[100.5,0]]],[[[110,0],[111,0],[111,1],[110,0]]]]}},{"type": "Feature","properties": {},"geometry": {"type": "Point","coordinates": [100,0]}}]}',
+        }
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + getUserToken())
+        response = self.client.post(url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        geo = Territory.objects.last().geo
+        self.assertEqual(geo.geom_type, "MultiPolygon")
+        self.assertEqual(len(geo), 2)
+        self.assertAlmostEqual(geo.area, 2.5)
+
     def test_api_can_create_territory(self):
         """
         Ensure we can create a new territory
@@ -292,6 +609,105 @@ class APITest(APITestCase):
         self.assertEqual(Territory.objects.count(), 3)
         self.assertEqual(Territory.objects.last().entity, self.new_nation)
 
+    def test_api_can_create_territories_bulk(self):
+        """
+        Ensure we can queue the creation of many territories from NDJSON
+        """
+        url = reverse("territory-bulk")
+        rows = [
+            {
+                "start_date": "00%02d-01-01" % year,
+                "end_date": "00%02d-12-31" % year,
+                "entity": self.new_nation.id,
+                "references": ["https://en.wikipedia.org/wiki/Test"],
+                "geo": '{"type": "Polygon","coordinates": [[[100,0],[101,0],[101,1],[100,1],[100,0]]]}',
+            }
+            for year in (10, 11, 12)
+        ]
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + getUserToken())
+        response = self.client.post(
+            url,
+            "\n".join(json.dumps(row) for row in rows),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(Territory.objects.count(), 2)
+
+        self.assertEqual(run_next().pk, response.data["job"])
+        job = self.client.get(reverse("job-detail", args=[response.data["job"]]))
+        self.assertEqual(job.data["status"], "done")
+        self.assertEqual(len(job.data["result"]["created"]), 3)
+        self.assertEqual(Territory.objects.count(), 5)
+        self.assertEqual(Territory.history.filter(history_type="+").count(), 5)
+
+    def test_api_can_not_create_territories_bulk(self):
+        """
+        Ensure bulk creation rejects the whole batch when rows overlap
+        """
+        url = reverse("territory-bulk")
+        row = {
+            "start_date": "0004-01-01",
+            "end_date": "0006-01-01",
+            "entity": self.new_nation.id,
+            "references": ["https://en.wikipedia.org/wiki/Test"],
+            "geo": '{"type": "Polygon","coordinates": [[[100,0],[101,0],[101,1],[100,1],[100,0]]]}',
+        }
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + getUserToken())
+        response = self.client.post(
+            url, [row, dict(row, start_date="0006-01-01")], format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        job = run_next()
+        self.assertEqual(job.status, "failed")
+        # The first row overlaps a stored territory, the second the first row
+        self.assertTrue(job.result["errors"][0])
+        self.assertTrue(job.result["errors"][1])
+        self.assertEqual(Territory.objects.count(), 2)
+        self.assertIsNone(run_next())
+
+    def test_worker_reclaims_abandoned_jobs(self):
+        """
+        Ensure jobs left running by a dead worker are run again, a few times
+        """
+        abandoned = Job.objects.create(
+            kind="simplify_territories",
+            payload={"ids": [self.territory.pk]},
+            status=Job.RUNNING,
+            started=now() - timedelta(days=1),
+            attempts=1,
+        )
+        live = Job.objects.create(
+            kind="simplify_territories",
+            payload={"ids": []},
+            status=Job.RUNNING,
+            started=now() - timedelta(days=1),
+            attempts=1,
+        )
+        # Another session holds the lock of the job its worker is running
+        worker = connection.copy()
+        try:
+            with worker.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_lock(%s, %s)", [JOB_LOCK_SPACE, live.pk]
+                )
+            job = run_next()
+            self.assertEqual(job.pk, abandoned.pk)
+            self.assertEqual(job.status, Job.DONE)
+            self.assertEqual(job.attempts, 2)
+            # Running jobs are left to their worker, however long they take
+            self.assertIsNone(run_next())
+            self.assertEqual(Job.objects.get(pk=live.pk).status, Job.RUNNING)
+        finally:
+            worker.close()
+
+        Job.objects.filter(pk=abandoned.pk).update(
+            status=Job.RUNNING, attempts=settings.JOB_MAX_ATTEMPTS
+        )
+        Job.objects.filter(pk=live.pk).update(status=Job.DONE)
+        self.assertIsNone(run_next())
+        self.assertEqual(Job.objects.get(pk=abandoned.pk).status, Job.FAILED)
+
     def test_api_can_update_PoliticalEntity(self):
         """
         Ensure we can update individual PoliticalEntities
@@ -334,6 +750,64 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data[0]["name"], "Test Nation")
 
+    def test_api_reads_politicalentities_non_polymorphic(self):
+        """
+        Ensure PoliticalEntity reads skip the polymorphic machinery, but writes
+        keep it
+        """
+        url = reverse("politicalentity-list")
+        view = PoliticalEntityViewSet(
+            request=Request(APIRequestFactory().get(url)), format_kwarg=None
+        )
+        self.assertTrue(view.get_queryset().polymorphic_disabled)
+        view.request = Request(APIRequestFactory().post(url))
+        self.assertFalse(view.get_queryset().polymorphic_disabled)
+
+    def test_api_can_search_PoliticalEntities(self):
+        """
+        Ensure PoliticalEntities can be searched by name, optionally restricted
+        to the ones with a territory on a date
+        """
+        url = reverse("politicalentity-search")
+        response = self.client.get(url, {"q": "child nation"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]["url_id"], "test_child_nation")
+
+        response = self.client.get(
+            url, {"q": "nation", "date": "0002-01-01"}, format="json"
+        )
+        self.assertEqual(
+            [entity["url_id"] for entity in response.data], ["test_nation"]
+        )
+
+        response = self.client.get(url, {"q": ""}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_api_can_query_PoliticalEntity_relations(self):
+        """
+        Ensure the relation graph of a PoliticalEntity can be queried
+        """
+        url = reverse("politicalentity-relations", args=["test_nation"])
+        response = self.client.get(url, {"date": "0002-01-01"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(edge["source"], edge["target"]) for edge in response.data["edges"]],
+            [(self.new_nation.id, self.child_nation.id)],
+        )
+        self.assertEqual(len(response.data["nodes"]), 2)
+
+        response = self.client.get(url, {"date": "0010-01-01"}, format="json")
+        self.assertEqual(response.data["edges"], [])
+
+        url = reverse("politicalentity-relations", args=["test_child_nation"])
+        response = self.client.get(
+            url, {"direction": "up", "types": "A"}, format="json"
+        )
+        self.assertEqual(response.data["edges"][0]["target"], self.new_nation.id)
+
+        response = self.client.get(url, {"types": "X"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_api_can_query_territories(self):
         """
         Ensure we can query for all territories
@@ -354,7 +828,152 @@ class APITest(APITestCase):
         geojson = json.dumps(geobuf.decode(gbuf))
         self.assertEqual(
             geojson,
-            '{"type": "MultiPolygon", "coordinates": [[[[102.0, 2.0], [103.0, 2.0], [103.0, 3.0], [102.0, 3.0], [102.0, 2.0]]], [[[100.0, 0.0], [101.0, 0.0], [101.0, 1.0], [100.0, 1.0], [100.0, 0.0]], [[100.2, 0.2], [100.8, 0.2], [100.8, 0.8], [100.2, 0.8], [100.2, 0.2]]]]}',
+            '{"type": "MultiPolygon", "coordinates": [[[[102.0, 2.0], [103.0, 2.0], [103.0, 3.0], [102.0, 3.0], [102.0, 2.0]]], [[[100.0, 0.0], [101.0, 0.0], [101.0, 1.0], [100.0, 1.0], [100.0, 0.0]], [[100.2, 0.2], [100.2, 0.8], [100.8, 0.8], [100.8, 0.2], [100.2, 0.2]]]]}',
+        )
+
+    def test_api_can_query_territories_geobuf(self):
+        """
+        Ensure territories can be fetched as a single geobuf FeatureCollection
+        """
+        url = reverse("territory-list") + "?format=geobuf"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-protobuf")
+        collection = geobuf.decode(response.content)
+        self.assertEqual(len(collection["features"]), 2)
+        feature = collection["features"][0]
+        self.assertEqual(feature["properties"]["entity"], "test_nation")
+        self.assertEqual(feature["geometry"]["type"], "MultiPolygon")
+
+    def test_api_can_query_territories_geobuf_sparse(self):
+        """
+        Ensure geobuf responses keep their geometry with sparse fieldsets, and
+        send errors as collection properties
+        """
+        url = reverse("territory-list") + "?format=geobuf&omit=geo"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        collection = geobuf.decode(response.content)
+        self.assertEqual(len(collection["features"]), 2)
+        self.assertEqual(collection["features"][0]["geometry"]["type"], "MultiPolygon")
+
+        url = reverse("territory-detail", args=[self.territory.id])
+        response = self.client.get(url + "?format=geobuf&fields=id,entity")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        features = geobuf.decode(response.content)["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["id"], self.territory.id)
+        self.assertEqual(features[0]["properties"]["entity"], "test_nation")
+        self.assertNotIn("references", features[0]["properties"])
+        self.assertEqual(features[0]["geometry"]["type"], "MultiPolygon")
+
+        url = reverse("territory-detail", args=[0])
+        response = self.client.get(url + "?format=geobuf")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        collection = geobuf.decode(response.content)
+        self.assertEqual(collection["features"], [])
+        self.assertIn("detail", collection)
+
+    def test_api_can_query_territories_base64(self):
+        """
+        Ensure geometry can be sent as base64 encoded geobuf
+        """
+        url = reverse("territory-list") + "?geo_encoding=base64"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        gbuf = base64.b64decode(response.data[0]["geo"])
+        self.assertEqual(geobuf.decode(gbuf)["type"], "MultiPolygon")
+
+    def test_api_can_export_territories(self):
+        """
+        Ensure filtered territories can be streamed as NDJSON and GeoJSONSeq
+        """
+        url = reverse("territory-export") + "?date=0001-01-01"
+        response = self.client.get(url + "&format=ndjson")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0].decode())["entity"], "test_nation")
+
+        response = self.client.get(url + "&format=geojsonseq")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        records = b"".join(response.streaming_content).split(b"\x1e")[1:]
+        feature = json.loads(records[0].decode())
+        self.assertEqual(feature["id"], self.territory.id)
+        self.assertEqual(feature["geometry"]["type"], "MultiPolygon")
+
+    def test_api_can_export_territories_zoom(self):
+        """
+        Ensure exports at a low zoom level stream simplified geometry
+        """
+        TerritoryFactory(
+            start_date="0040-01-01",
+            end_date="0041-01-01",
+            entity=self.new_nation,
+            references=["https://en.wikipedia.org/wiki/Test"],
+            geo=MultiPolygon(Point(100.0, 0.0, srid=4326).buffer(1.0, quadsegs=64)),
+        )
+        run_jobs()
+        url = reverse("territory-export") + "?date=0040-01-01&format=geojsonseq"
+
+        def ring_size(params):
+            response = self.client.get(url + params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            records = b"".join(response.streaming_content).split(b"\x1e")[1:]
+            feature = json.loads(records[0].decode())
+            return len(feature["geometry"]["coordinates"][0][0])
+
+        self.assertLess(ring_size("&zoom=2"), ring_size(""))
+
+    def test_api_can_paginate_territories(self):
+        """
+        Ensure territories can be paged through with a cursor
+        """
+        url = reverse("territory-list") + "?page_size=1"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["id"], self.territory.id)
+        self.assertIsNone(response.data["previous"])
+
+        response = self.client.get(response.data["next"], format="json")
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["id"], self.territory2.id)
+        self.assertIsNone(response.data["next"])
+
+    def test_api_can_query_territories_sparse(self):
+        """
+        Ensure fields can be picked or omitted, without loading the others
+        """
+        url = reverse("territory-list")
+        response = self.client.get(url + "?omit=geo", format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("geo", response.data[0])
+        self.assertIn("references", response.data[0])
+
+        response = self.client.get(url + "?fields=id,entity", format="json")
+        self.assertEqual(set(response.data[0]), {"id", "entity"})
+
+        request = Request(APIRequestFactory().get(url, {"fields": "id,entity"}))
+        view = TerritoryViewSet(request=request, format_kwarg=None, action="list")
+        names, defer = view.get_queryset().query.deferred_loading
+        self.assertTrue(defer)
+        self.assertEqual(
+            set(names),
+            {
+                "start_date",
+                "end_date",
+                "geo",
+                "encoded_geo",
+                "references",
+                "raw_vertex_count",
+                "vertex_count",
+                "entity__name",
+                "entity__references",
+                "entity__links",
+                "entity__description",
+                "entity__aliases",
+            },
         )
 
     def test_api_can_query_territory(self):
@@ -392,6 +1011,36 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(not response.data)
 
+    def test_api_can_query_territories_bbox(self):
+        """
+        Ensure we can query for territories with a bounding box, optionally
+        skipping the exact geometry test
+        """
+        url = reverse("territory-list") + "?bbox=0,0,150,150"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]["entity"], "test_nation")
+
+        # Inside the territories' extent, but between their polygons
+        url = reverse("territory-list") + "?bbox=101.5,0.2,101.9,0.8"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(not response.data)
+        response = self.client.get(url + "&bbox_exact=false", format="json")
+        self.assertEqual(len(response.data), 2)
+
+    def test_api_can_not_query_territories_bad_bbox(self):
+        """
+        Ensure malformed bounding boxes are rejected
+        """
+        for bbox in ("0,0,150", "0,0,a,150", "150,0,0,150", "0,0,nan,150"):
+            url = reverse("territory-list") + "?bbox=" + bbox
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        url = reverse("territory-list") + "?bounds=__import__('os')"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_api_can_query_territories_date(self):
         """
         Ensure we can query for territories with a date
@@ -401,6 +1050,163 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data[0]["entity"], "test_nation")
 
+    def test_api_caches_territories_date(self):
+        """
+        Ensure dates in the same epoch share a snapshot, which is dropped
+        when a territory in that epoch changes
+        """
+        url = reverse("territory-list") + "?date="
+        response = self.client.get(url + "0002-01-01", format="json")
+        self.assertEqual(len(response.data), 1)
+
+        # Changes that bypass the signals are not seen by the snapshot
+        Territory.objects.filter(pk=self.territory.pk).update(start_date="0003-01-01")
+        response = self.client.get(url + "0002-06-01", format="json")
+        self.assertEqual(len(response.data), 1)
+
+        TerritoryFactory(
+            start_date="0002-01-01",
+            end_date="0002-12-31",
+            entity=self.child_nation,
+            references=["https://en.wikipedia.org/wiki/Test"],
+            geo=self.territory.geo,
+        )
+        response = self.client.get(url + "0002-06-01", format="json")
+        self.assertEqual(
+            [territory["entity"] for territory in response.data], ["test_child_nation"]
+        )
+
+    def test_api_answers_conditional_get(self):
+        """
+        Ensure unchanged territories are answered with 304 Not Modified
+        """
+        url = reverse("territory-list")
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+        TerritoryFactory(
+            start_date="0040-01-01",
+            end_date="0041-01-01",
+            entity=self.new_nation,
+            references=["https://en.wikipedia.org/wiki/Test"],
+            geo=GEOSGeometry(
+                '{"type": "Polygon","coordinates": [[[100,0],[101,0],[101,1],[100,1],[100,0]]]}'
+            ),
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_api_conditional_get_follows_simplification(self):
+        """
+        Ensure zoomed territories are not answered with 304 once a worker
+        rebuilt their simplified geometries
+        """
+        url = reverse("territory-list") + "?zoom=%d" % settings.TERRITORY_ZOOM_LEVELS[0]
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Job.objects.create(
+            kind="simplify_territories", payload={"ids": [self.territory.pk]}
+        )
+        run_jobs()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_api_conditional_get_follows_parties(self):
+        """
+        Ensure diplomatic relations are not answered with 304 once one of their
+        parties changed
+        """
+        url = reverse("diplomaticrelation-list")
+        etag = self.client.get(url)["ETag"]
+
+        nation = PoliticalEntity.objects.get(pk=self.new_nation.pk)
+        nation.url_id = "renamed_nation"
+        nation.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_api_caches_responses(self):
+        """
+        Ensure repeated reads are served from the response cache until the
+        data changes
+        """
+        url = reverse("politicalentity-list")
+        self.client.get(url, format="json")
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(stats(["politicalentities"])["politicalentities"]["hits"], 1)
+
+        nation = PoliticalEntity.objects.get(pk=self.new_nation.pk)
+        nation.description = "Changed"
+        nation.save()
+        response = self.client.get(url, format="json")
+        self.assertIn("Changed", [entity["description"] for entity in response.data])
+        response = self.client.get(reverse("cache-stats"), format="json")
+        self.assertEqual(response.data["politicalentities"]["misses"], 2)
+
+    def test_api_query_count_does_not_grow_with_rows(self):
+        """
+        Ensure list requests run the same number of queries whatever the
+        number of rows they return
+        """
+        urls = [reverse("territory-list"), reverse("diplomaticrelation-list")]
+
+        def query_counts():
+            caches["responses"].clear()
+            return [int(self.client.get(url)["X-Query-Count"]) for url in urls]
+
+        # Warm up the process wide caches (content types, ...) first
+        query_counts()
+        before = query_counts()
+
+        for year in (50, 51, 52):
+            TerritoryFactory(
+                start_date="00%d-01-01" % year,
+                end_date="00%d-12-31" % year,
+                entity=self.child_nation,
+                references=["https://en.wikipedia.org/wiki/Test"],
+                geo=self.territory.geo,
+            )
+            diprel = DiplomaticRelationFactory(
+                start_date="00%d-01-01" % year,
+                end_date="00%d-12-31" % year,
+                references=["https://en.wikipedia.org/wiki/Test"],
+                diplo_type="A",
+            )
+            diprel.parent_parties.add(self.new_nation)
+            diprel.child_parties.add(self.child_nation)
+
+        self.assertEqual(query_counts(), before)
+
+    def test_api_can_query_territories_delta(self):
+        """
+        Ensure moving the timeline only sends the territories that changed
+        """
+        url = reverse("territory-delta") + "?from=0004-01-01&to=0031-01-01"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["remove"], [self.territory.id])
+        self.assertEqual(
+            [territory["id"] for territory in response.data["add"]],
+            [self.territory2.id],
+        )
+
+        url = reverse("territory-delta") + "?from=0002-01-01&to=0004-01-01"
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.data, {"remove": [], "add": []})
+
+        response = self.client.get(reverse("territory-delta") + "?from=0002-01-01")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_api_can_not_query_territories_date(self):
         """
         Ensure querying for territories with an earlier start
@@ -411,6 +1217,59 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(not response.data)
 
+    def test_api_can_query_territories_zoom(self):
+        """
+        Ensure low zoom levels are served simplified geometry
+        """
+        detailed = TerritoryFactory(
+            start_date="0040-01-01",
+            end_date="0041-01-01",
+            entity=self.new_nation,
+            references=["https://en.wikipedia.org/wiki/Test"],
+            geo=MultiPolygon(Point(100.0, 0.0, srid=4326).buffer(1.0, quadsegs=64)),
+        )
+        url = reverse("territory-detail", args=[detailed.id])
+        response = self.client.get(url, format="json")
+        full = geobuf.decode(bytes.fromhex(response.data["geo"]))
+        # The full geometry is served until a worker simplified it
+        response = self.client.get(url + "?zoom=2", format="json")
+        self.assertEqual(geobuf.decode(bytes.fromhex(response.data["geo"])), full)
+        run_jobs()
+        response = self.client.get(url + "?zoom=2", format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        coarse = geobuf.decode(bytes.fromhex(response.data["geo"]))
+        self.assertLess(
+            len(coarse["coordinates"][0][0]), len(full["coordinates"][0][0])
+        )
+
+    def test_api_can_query_tile(self):
+        """
+        Ensure vector tiles are cached until a territory inside them changes
+        """
+        tile_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tile_dir, True)
+        with self.settings(TILE_CACHE_DIR=tile_dir):
+            url = reverse("territory-tile", args=[0, 0, 0])
+            response = self.client.get(url + "?date=0002-01-01")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response["Content-Type"], "application/vnd.mapbox-vector-tile"
+            )
+            self.assertTrue(response.content)
+            self.assertTrue(os.path.isdir(os.path.join(tile_dir, "0", "0", "0")))
+
+            self.territory.save()
+            self.assertFalse(os.path.isdir(os.path.join(tile_dir, "0", "0", "0")))
+
+            # Tiles embed the url_id and color of entities
+            self.client.get(url + "?date=0002-01-01")
+            self.new_nation.color = "000"
+            self.new_nation.save()
+            self.assertFalse(os.path.isdir(os.path.join(tile_dir, "0", "0", "0")))
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_api_can_query_PoliticalEntity(self):
         """
         Ensure we can query individual PoliticalEntities
@@ -485,3 +1344,210 @@ class APITest(APITestCase):
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["diplo_type"], "A")
+
+    def test_api_can_filter_diprels(self):
+        """
+        Ensure we can filter DipRels by date, party and type
+        """
+        other = DiplomaticRelationFactory(
+            start_date="0010-01-01",
+            end_date="0020-01-01",
+            references=["https://en.wikipedia.org/wiki/Test"],
+            diplo_type="D",
+        )
+        other.parent_parties.add(self.child_nation)
+        other.child_parties.add(self.new_nation)
+        url = reverse("diplomaticrelation-list")
+
+        def ids(params):
+            response = self.client.get(url, params, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [relation["id"] for relation in response.data]
+
+        self.assertEqual(ids({"date": "0003-01-01"}), [self.diprel.id])
+        self.assertEqual(ids({"date": "0015-01-01"}), [other.id])
+        self.assertEqual(
+            sorted(ids({"entity": self.new_nation.id})), [self.diprel.id, other.id]
+        )
+        self.assertEqual(
+            ids({"entity": self.child_nation.id, "diplo_type": "D"}), [other.id]
+        )
+        self.assertEqual(ids({"date": "0030-01-01"}), [])
+
+
+@isolated_caches
+@commit_immediately
+class ShapefileTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.nation = PoliticalEntityFactory(
+            name="Shapefile Nation",
+            url_id="shapefile_nation",
+            color="fff",
+            references=["https://en.wikipedia.org/wiki/Test"],
+            aliases=[],
+            links=[],
+        )
+
+    def upload(self, data):
+        return TerritoryForm(
+            {
+                "start_date": "0001-01-01",
+                "end_date": "0002-01-01",
+                "entity": self.nation.pk,
+                "references": "https://en.wikipedia.org/wiki/Test",
+            },
+            {"shape_file": SimpleUploadedFile("territory.zip", data)},
+        )
+
+    def read(self, data):
+        form = self.upload(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.cleaned_data["shape_file"]
+
+    def test_form_reads_shapefile_members(self):
+        """
+        Ensure every shapefile of the archive is merged, with or without workers
+        """
+        data = shapefile_zip(
+            {
+                "west": ([[square(0, 0, 1, 1)]], None),
+                "east": ([[square(2, 0, 3, 1)], [square(4, 0, 5, 1)]], None),
+            }
+        )
+        for workers in (0, 2):
+            with self.settings(SHAPEFILE_WORKERS=workers):
+                geo = self.read(data)
+            self.assertEqual(geo.geom_type, "MultiPolygon")
+            self.assertEqual(len(geo), 3)
+            self.assertAlmostEqual(geo.area, 3)
+
+    def test_form_reads_shapefile_multipolygons(self):
+        """
+        Ensure records made of several polygons keep all of them, and their holes
+        """
+        hole = square(0.25, 0.25, 0.75, 0.75)[::-1]
+        geo = self.read(
+            shapefile_zip(
+                {"islands": ([[square(0, 0, 1, 1), hole, square(2, 0, 3, 1)]], None)}
+            )
+        )
+        self.assertEqual(len(geo), 2)
+        self.assertAlmostEqual(geo.area, 1.75)
+
+        form = self.upload(
+            shapefile_zip(
+                {"islands": ([[square(0, 0, 1, 1), square(2, 0, 3, 1)]], None)}
+            )
+        )
+        territory = form.save() if form.is_valid() else None
+        self.assertIsNotNone(territory, form.errors)
+        self.assertEqual(Territory.objects.get(pk=territory.pk).geo.num_geom, 2)
+
+    def test_form_reprojects_shapefiles(self):
+        """
+        Ensure shapefiles with a .prj are transformed to WGS84
+        """
+        # One degree of longitude and latitude from the origin, in web mercator
+        geo = self.read(
+            shapefile_zip(
+                {
+                    "mercator": (
+                        [[square(0, 0, 111319.49079327357, 111325.1428663851)]],
+                        SpatialReference(3857).wkt,
+                    )
+                }
+            )
+        )
+        self.assertEqual(geo.srid, 4326)
+        for coordinate, expected in zip(geo.extent, (0, 0, 1, 1)):
+            self.assertAlmostEqual(coordinate, expected, places=6)
+
+    def test_form_can_not_read_corrupt_shapefiles(self):
+        """
+        Ensure unreadable archives are reported as form errors
+        """
+        archive = BytesIO()
+        with ZipFile(archive, "w") as zipped:
+            zipped.writestr("territory.txt", b"")
+        broken = BytesIO()
+        with ZipFile(broken, "w") as zipped:
+            zipped.writestr("territory.shp", b"not a shapefile")
+        for data, error in (
+            (b"not a zip", "Could not read zipfile."),
+            (archive.getvalue(), "The zipfile does not contain a shapefile."),
+            (broken.getvalue(), "Error converting shapefile"),
+        ):
+            form = self.upload(data)
+            self.assertFalse(form.is_valid())
+            self.assertEqual(form.errors["shape_file"], [error])
+
+
+class JWKSTest(TestCase):
+    def setUp(self):
+        """
+        Write a local JWKS file holding a freshly generated key
+        """
+        self.private_key = self.write_jwks("test_key")
+
+    def write_jwks(self, kid):
+        private_key = rsa.generate_private_key(65537, 2048, default_backend())
+        jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+        jwk["kid"] = kid
+        handle, self.path = mkstemp(suffix=".json")
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(handle, "w") as jwks:
+            json.dump({"keys": [jwk]}, jwks)
+        return private_key
+
+    def sign(self, private_key, kid):
+        return jwt.encode(
+            {"sub": "test"}, private_key, algorithm="RS256", headers={"kid": kid}
+        )
+
+    def test_key_cache_selects_key_by_kid(self):
+        """
+        Ensure tokens are verified with the key matching their kid
+        """
+        keys = KeyCache(FileSource(self.path))
+        token = self.sign(self.private_key, "test_key")
+        public_key = keys.get(jwt.get_unverified_header(token)["kid"])
+        self.assertEqual(
+            jwt.decode(token, public_key, algorithms=["RS256"])["sub"], "test"
+        )
+        with self.assertRaises(SigningKeyNotFound):
+            keys.get("unknown_key")
+
+    def test_key_cache_refetches_unknown_kid(self):
+        """
+        Ensure rotated keys are picked up without waiting for the cache to expire
+        """
+        keys = KeyCache(FileSource(self.path), min_interval=0)
+        keys.get("test_key")
+        rotated_key = self.write_jwks("rotated_key")
+        keys.source = FileSource(self.path)
+        token = self.sign(rotated_key, "rotated_key")
+        public_key = keys.get("rotated_key")
+        self.assertEqual(
+            jwt.decode(token, public_key, algorithms=["RS256"])["sub"], "test"
+        )
+
+    def test_key_cache_reads_pem_file(self):
+        """
+        Ensure a local PEM public key can stand in for the JWKS
+        """
+        handle, path = mkstemp(suffix=".pem")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, "wb") as pem:
+            pem.write(
+                self.private_key.public_key().public_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PublicFormat.SubjectPublicKeyInfo,
+                )
+            )
+        keys = KeyCache(PEMFileSource(path))
+        token = self.sign(self.private_key, "any_key")
+        public_key = keys.get("any_key")
+        self.assertEqual(
+            jwt.decode(token, public_key, algorithms=["RS256"])["sub"], "test"
+        )
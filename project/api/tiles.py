@@ -0,0 +1,163 @@
+"""
+Mapbox Vector Tiles of the territories active on a date, cached on disk by
+(z, x, y, epoch) and invalidated by bounding box when territories change.
+"""
+import os
+import shutil
+from math import asinh, atan, degrees, floor, pi, radians, sinh, tan
+from tempfile import NamedTemporaryFile
+from time import time
+
+from django.conf import settings
+from django.db import connection
+
+from .epochs import epoch_for
+from .models import Entity, PoliticalEntity, Territory
+
+# Half the width of the web mercator projection in meters
+MERCATOR_EXTENT = 20037508.342789244
+# Latitude at which web mercator tiles are cut off
+MERCATOR_MAX_LAT = 85.0511287798066
+# Tile resolution and the clipping buffer around it, in tile units
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+TILE_SQL = """
+SELECT ST_AsMVT(tile, 'territories', %(extent)s, 'geom') FROM (
+    SELECT
+        territory.id,
+        entity.url_id AS entity,
+        political.color,
+        ST_AsMVTGeom(
+            ST_Transform(ST_ClipByBox2D(territory.geo, {clip}), 3857),
+            ST_MakeEnvelope(%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, 3857),
+            %(extent)s,
+            %(buffer)s,
+            true
+        ) AS geom
+    FROM {territory} territory
+    JOIN {entity} entity ON entity.id = territory.entity_id
+    LEFT JOIN {political} political ON political.entity_ptr_id = entity.id
+    WHERE daterange(territory.start_date, territory.end_date, '[]') @> %(date)s::date
+        AND territory.geo && {clip}
+) AS tile
+WHERE tile.geom IS NOT NULL
+""".format(
+    territory=Territory._meta.db_table,
+    entity=Entity._meta.db_table,
+    political=PoliticalEntity._meta.db_table,
+    clip="ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s, 4326)",
+)
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the (west, south, east, north) bounds of a tile in degrees
+    """
+    n = 2 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = degrees(atan(sinh(pi * (1 - 2 * y / n))))
+    south = degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def tile_range(z, extent):
+    """
+    Returns the (xmin, ymin, xmax, ymax) tile indices covering an extent in degrees
+    """
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(max(int(floor((lon + 180.0) / 360.0 * n)), 0), n - 1)
+
+    def tile_y(lat):
+        lat = radians(min(max(lat, -MERCATOR_MAX_LAT), MERCATOR_MAX_LAT))
+        return min(max(int(floor((1 - asinh(tan(lat)) / pi) / 2 * n)), 0), n - 1)
+
+    xmin, ymin, xmax, ymax = extent
+    return tile_x(xmin), tile_y(ymax), tile_x(xmax), tile_y(ymin)
+
+
+def render_tile(z, x, y, date):
+    """
+    Builds the clipped and quantized vector tile of the territories active on date
+    """
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    west, south, east, north = tile_bounds(z, x, y)
+    # Clip a little outside of the tile so polygon edges are not drawn at its border
+    margin = float(TILE_BUFFER) / TILE_EXTENT
+    params = {
+        "date": date,
+        "extent": TILE_EXTENT,
+        "buffer": TILE_BUFFER,
+        "minx": -MERCATOR_EXTENT + x * size,
+        "maxx": -MERCATOR_EXTENT + (x + 1) * size,
+        "miny": MERCATOR_EXTENT - (y + 1) * size,
+        "maxy": MERCATOR_EXTENT - y * size,
+        "west": west - (east - west) * margin,
+        "east": east + (east - west) * margin,
+        "south": max(south - (north - south) * margin, -MERCATOR_MAX_LAT),
+        "north": min(north + (north - south) * margin, MERCATOR_MAX_LAT),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(TILE_SQL, params)
+        row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else b""
+
+
+def tile_path(z, x, y, epoch):
+    return os.path.join(
+        settings.TILE_CACHE_DIR,
+        str(z),
+        str(x),
+        str(y),
+        "%s.mvt" % (epoch.isoformat() if epoch is not None else "origin"),
+    )
+
+
+def get_tile(z, x, y, date):
+    """
+    Returns the tile for date from the disk cache, rendering it on a miss
+    """
+    path = tile_path(z, x, y, epoch_for(date))
+    try:
+        # A tile rendered while a change was being written may be stored after
+        # the change invalidated it, so tiles are only kept for a while
+        if time() - os.path.getmtime(path) < settings.TILE_CACHE_TIMEOUT:
+            with open(path, "rb") as cached:
+                return cached.read()
+    except FileNotFoundError:
+        pass
+
+    tile = render_tile(z, x, y, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write through a temporary file so concurrent readers never see partial tiles
+    with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as temp:
+        temp.write(tile)
+    os.replace(temp.name, path)
+    return tile
+
+
+def invalidate_tiles(extents):
+    """
+    Removes every cached tile, for all epochs, touching one of the given extents
+    """
+    root = settings.TILE_CACHE_DIR
+    if not os.path.isdir(root):
+        return
+
+    for zoom in os.listdir(root):
+        if not zoom.isdigit():
+            continue
+        for extent in extents:
+            if extent is None:
+                continue
+            xmin, ymin, xmax, ymax = tile_range(int(zoom), extent)
+            # Only walk the tiles that were actually cached
+            for x in os.listdir(os.path.join(root, zoom)):
+                if not x.isdigit() or not xmin <= int(x) <= xmax:
+                    continue
+                for y in os.listdir(os.path.join(root, zoom, x)):
+                    if y.isdigit() and ymin <= int(y) <= ymax:
+                        shutil.rmtree(os.path.join(root, zoom, x, y), True)
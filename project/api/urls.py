@@ -7,5 +7,13 @@ ROUTER = DefaultRouter()
 ROUTER.register(r"politicalentities", views.PoliticalEntityViewSet)
 ROUTER.register(r"territories", views.TerritoryViewSet)
 ROUTER.register(r"diprels", views.DiplomaticRelationViewSet)
+ROUTER.register(r"jobs", views.JobViewSet)
 
-urlpatterns = [path("", include(ROUTER.urls)), path("signup/", views.signup)]
+urlpatterns = [
+    path("", include(ROUTER.urls)),
+    path(
+        "tiles/<int:z>/<int:x>/<int:y>.mvt", views.territory_tile, name="territory-tile"
+    ),
+    path("cache/stats/", views.cache_stats, name="cache-stats"),
+    path("signup/", views.signup),
+]
@@ -1,4 +1,24 @@
+import jwt
 from django.contrib.auth import authenticate
+from rest_framework_jwt.settings import api_settings
+
+from .jwks import signing_key
+
+
+def jwt_decode_handler(token):
+    """
+    Verifies access tokens against the cached Auth0 key matching their kid
+    """
+    return jwt.decode(
+        token,
+        signing_key(token),
+        api_settings.JWT_VERIFY,
+        options={"verify_exp": api_settings.JWT_VERIFY_EXPIRATION},
+        leeway=api_settings.JWT_LEEWAY,
+        audience=api_settings.JWT_AUDIENCE,
+        issuer=api_settings.JWT_ISSUER,
+        algorithms=[api_settings.JWT_ALGORITHM],
+    )
 
 
 def jwt_get_username_from_payload_handler(payload):
@@ -1,58 +1,401 @@
+from itertools import islice
+
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import Group
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
-from rest_framework import viewsets, permissions
+from django.http import (
+    StreamingHttpResponse,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    Http404,
+)
+from django.conf import settings
+from django.db.models import Prefetch, prefetch_related_objects
+from django.forms import ValidationError as FormValidationError
+from django.utils.dateparse import parse_date
+from django.views.decorators.http import require_GET
+from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 
-from .models import PoliticalEntity, Territory, DiplomaticRelation
+from .models import PoliticalEntity, Territory, DiplomaticRelation, Job
 from .serializers import (
     PoliticalEntitySerializer,
     TerritorySerializer,
     DiplomaticRelationSerializer,
+    JobSerializer,
 )
-from .filters import TerritoryFilter
+from .jobs import enqueue
+from .mixins import CachedResponseMixin, ConditionalGetMixin, SparseQuerysetMixin
+from . import response_cache
+from .epochs import epoch_for, get_snapshot, SNAPSHOT_VARIANTS
+from .filters import BoundingBoxField, DiplomaticRelationFilter, TerritoryFilter
+from .parsers import NDJSONParser
+from .relations import relation_graph
+from .search import search_entities
+from .renderers import GeobufRenderer, NDJSONRenderer, GeoJSONSeqRenderer
+from .tiles import get_tile
+
+
+def date_param(params, name, required=False):
+    """
+    Returns the YYYY-MM-DD query parameter name, or None if it is optional and
+    absent. Raises a ValidationError for invalid dates.
+    """
+    value = params.get(name)
+    if value is None and not required:
+        return None
+    try:
+        date = parse_date(value or "")
+    except ValueError:
+        date = None
+    if date is None:
+        raise ValidationError({name: "A valid date (YYYY-MM-DD) is required."})
+    return date
 
 
-class PoliticalEntityViewSet(viewsets.ModelViewSet):
+def iterate_prefetched(queryset, chunk_size):
+    """
+    Iterates over a queryset through a server-side cursor like
+    queryset.iterator(), which ignores prefetch_related, and resolves the
+    prefetched relations of each chunk of rows
+    """
+    lookups = queryset._prefetch_related_lookups
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        prefetch_related_objects(chunk, *lookups)
+        yield from chunk
+
+
+class PoliticalEntityViewSet(
+    CachedResponseMixin, ConditionalGetMixin, SparseQuerysetMixin, viewsets.ModelViewSet
+):
     """
     Viewset for the PoliticalEntity model
     """
 
+    cache_resource = "politicalentities"
+    query_budget = 6
+    query_time_budget = 1000
+    # Needed to resolve the real class of polymorphic rows
+    always_loaded = ("polymorphic_ctype",)
+    history_models = (PoliticalEntity,)
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     queryset = PoliticalEntity.objects.all()
     serializer_class = PoliticalEntitySerializer
     lookup_field = "url_id"
 
+    def get_history_models(self):
+        # Searches by date and relation graphs depend on more than entities
+        if self.action == "search":
+            return self.history_models + (Territory,)
+        if self.action == "relations":
+            return self.history_models + (DiplomaticRelation,)
+        return self.history_models
+
+    def get_queryset(self):
+        queryset = super(PoliticalEntityViewSet, self).get_queryset()
+        if self.request.method in ("GET", "HEAD"):
+            # PoliticalEntity has no subclasses, so reads can skip resolving the
+            # real class of every row
+            queryset = queryset.non_polymorphic()
+        return queryset
+
+    @action(detail=False)
+    def search(self, request):
+        """
+        Entities whose name, aliases or description match ?q=, best first. Takes
+        an optional ?limit= and ?date=YYYY-MM-DD to only return entities with a
+        territory on that date.
+        """
+        params = request.query_params
+        q = params.get("q", "").strip()
+        if not q:
+            raise ValidationError({"q": "A search query is required."})
+        try:
+            limit = int(params.get("limit", settings.SEARCH_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= settings.SEARCH_MAX_LIMIT:
+            raise ValidationError(
+                {"limit": "limit must be between 1 and %d." % settings.SEARCH_MAX_LIMIT}
+            )
+        ids = search_entities(q, limit, date_param(params, "date"))
+        entities = self.get_queryset().in_bulk(ids)
+        return Response(
+            self.get_serializer(
+                [entities[pk] for pk in ids if pk in entities], many=True
+            ).data
+        )
+
+    @action(detail=True)
+    def relations(self, request, url_id=None):
+        """
+        Graph of the entities this entity is a parent party of, transitively
+        (?direction=up follows child to parent instead). Takes ?date=YYYY-MM-DD,
+        ?types= (comma separated diplo_types) and ?depth=.
+        """
+        params = request.query_params
+        types = [value for value in params.get("types", "").split(",") if value]
+        known = {choice for choice, _ in DiplomaticRelation.DIPLO_TYPE_CHOICES}
+        if set(types) - known:
+            raise ValidationError(
+                {"types": "Unknown types: %s." % ", ".join(sorted(set(types) - known))}
+            )
+        try:
+            depth = int(params.get("depth", settings.RELATIONS_MAX_DEPTH))
+        except ValueError:
+            depth = 0
+        if not 0 < depth <= settings.RELATIONS_MAX_DEPTH:
+            raise ValidationError(
+                {
+                    "depth": "depth must be between 1 and %d."
+                    % settings.RELATIONS_MAX_DEPTH
+                }
+            )
+        direction = params.get("direction", "down")
+        if direction not in ("down", "up"):
+            raise ValidationError({"direction": "direction must be down or up."})
+
+        return Response(
+            relation_graph(
+                self.get_object().pk,
+                depth,
+                date=date_param(params, "date"),
+                types=types,
+                up=direction == "up",
+            )
+        )
+
     # TODO use request.user to update revision table
 
 
-class TerritoryViewSet(viewsets.ModelViewSet):
+class TerritoryViewSet(
+    CachedResponseMixin, ConditionalGetMixin, SparseQuerysetMixin, viewsets.ModelViewSet
+):
     """
     Viewset for the Territory model
     """
 
+    cache_resource = "territories"
+    query_budget = 8
+    query_time_budget = 1000
+    # Territories are serialized with the url_id of their entity
+    history_models = (Territory, PoliticalEntity)
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     serializer_class = TerritorySerializer
     filter_class = TerritoryFilter
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (GeobufRenderer,)
+
+    # Only the url_id of entities is serialized
+    queryset = Territory.objects.select_related("entity").defer(
+        "entity__name",
+        "entity__references",
+        "entity__links",
+        "entity__description",
+        "entity__aliases",
+    )
+
+    # Query parameters a cached epoch snapshot can answer
+    SNAPSHOT_PARAMS = {"date", "format", "geo_encoding"}
+
+    def latest_history(self):
+        latest = super(TerritoryViewSet, self).latest_history()
+        # Zoomed responses also change when a worker rebuilds simplified geometries
+        if "zoom" in self.request.query_params:
+            latest.append(
+                Job.objects.filter(kind="simplify_territories", finished__isnull=False)
+                .order_by("-finished")
+                .values_list("id", "finished")
+                .first()
+            )
+        return latest
+
+    def cache_params(self, request):
+        # Dates of the same epoch and boxes widened to the same grid cells are
+        # answered with the same territories
+        params = dict(request.query_params.lists())
+        try:
+            bbox = BoundingBoxField(required=False).clean(params.get("bbox", [""])[0])
+        except FormValidationError:
+            bbox = None
+        if bbox is not None:
+            params["bbox"] = [bbox.extent]
+        try:
+            date = parse_date(params.get("date", [""])[0])
+        except ValueError:
+            date = None
+        if date is not None:
+            params["date"] = [epoch_for(date)]
+        return sorted(params.items())
+
+    def list(self, request, *args, **kwargs):
+        # Plain ?date= queries are answered from the snapshot of the date's epoch
+        params = request.query_params
+        variant = params.get("geo_encoding", "hex")
+        try:
+            date = parse_date(params.get("date", ""))
+        except ValueError:
+            date = None
+        if (
+            date is None
+            or set(params) - self.SNAPSHOT_PARAMS
+            or variant not in SNAPSHOT_VARIANTS
+            or getattr(request.accepted_renderer, "geojson_geometry", False)
+        ):
+            return super(TerritoryViewSet, self).list(request, *args, **kwargs)
+
+        def serialize():
+            queryset = self.filter_queryset(self.get_queryset())
+            return list(self.get_serializer(queryset, many=True).data)
 
-    queryset = Territory.objects.all()
+        return Response(get_snapshot(date, variant, serialize))
+
+    @action(detail=False, renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES)
+    def delta(self, request):
+        """
+        Territories to remove and add when moving the timeline between two dates
+        (?from=YYYY-MM-DD&to=YYYY-MM-DD), other filters still apply
+        """
+        dates = {
+            param: date_param(request.query_params, param, required=True)
+            for param in ("from", "to")
+        }
+
+        queryset = self.filter_queryset(self.get_queryset())
+        removed = (
+            queryset.active_on(dates["from"])
+            .exclude(period__contains=dates["to"])
+            .values_list("id", flat=True)
+        )
+        added = queryset.active_on(dates["to"]).exclude(period__contains=dates["from"])
+        return Response(
+            {"remove": list(removed), "add": self.get_serializer(added, many=True).data}
+        )
+
+    @action(detail=False, renderer_classes=(NDJSONRenderer, GeoJSONSeqRenderer))
+    def export(self, request):
+        """
+        Streams the filtered territories one line at a time (?format=ndjson or
+        ?format=geojsonseq) through a server-side cursor
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer()
+        renderer = request.accepted_renderer
+        lines = (
+            renderer.render_item(serializer.to_representation(territory))
+            for territory in iterate_prefetched(queryset, settings.EXPORT_CHUNK_SIZE)
+        )
+        return StreamingHttpResponse(lines, content_type=renderer.media_type)
+
+    @action(
+        detail=False,
+        methods=["post"],
+        parser_classes=(JSONParser, NDJSONParser),
+        renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES,
+    )
+    def bulk(self, request):
+        """
+        Queues the creation of many territories from a JSON array or NDJSON body,
+        all or nothing. The job's result lists the created ids, or the errors
+        of each submitted row.
+        """
+        if not isinstance(request.data, list):
+            raise ValidationError(
+                {"non_field_errors": ["Expected a list of territories."]}
+            )
+
+        user = request.user if request.user.is_authenticated else None
+        job = enqueue("create_territories", {"rows": request.data}, user=user)
+        return Response(
+            {"job": job.pk},
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": reverse("job-detail", args=[job.pk], request=request)},
+        )
 
     # TODO use request.user to update revision table
 
 
-class DiplomaticRelationViewSet(viewsets.ModelViewSet):
+class DiplomaticRelationViewSet(
+    CachedResponseMixin, ConditionalGetMixin, SparseQuerysetMixin, viewsets.ModelViewSet
+):
     """
     Viewset for the DiplomaticRelation model
     """
 
+    cache_resource = "diprels"
+    query_budget = 6
+    query_time_budget = 1000
+    # Relations are serialized with the url_id of their parties
+    history_models = (DiplomaticRelation, PoliticalEntity)
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-    queryset = DiplomaticRelation.objects.all()
+    queryset = DiplomaticRelation.objects.prefetch_related(
+        Prefetch("parent_parties", queryset=PoliticalEntity.objects.non_polymorphic()),
+        Prefetch("child_parties", queryset=PoliticalEntity.objects.non_polymorphic()),
+    )
     serializer_class = DiplomaticRelationSerializer
+    filter_class = DiplomaticRelationFilter
 
     # TODO use request.user to update revision table
 
 
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Status of the background jobs queued by heavy writes
+    """
+
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+
+
+@api_view()
+def cache_stats(request):
+    """
+    Hit and miss counters of the response cache
+    """
+    return Response(
+        response_cache.stats(
+            [
+                viewset.cache_resource
+                for viewset in (
+                    PoliticalEntityViewSet,
+                    TerritoryViewSet,
+                    DiplomaticRelationViewSet,
+                )
+            ]
+        )
+    )
+
+
+@require_GET
+def territory_tile(request, z, x, y):
+    """
+    Mapbox Vector Tile of the territories active on the requested date
+    """
+    if z > settings.TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404("Tile out of range")
+    try:
+        date = parse_date(request.GET.get("date", ""))
+    except ValueError:
+        date = None
+    if date is None:
+        return HttpResponseBadRequest("A valid date=YYYY-MM-DD is required")
+
+    return HttpResponse(
+        get_tile(z, x, y, date), content_type="application/vnd.mapbox-vector-tile"
+    )
+
+
 def signup(request):
     if request.method == "POST":
         form = UserCreationForm(request.POST)
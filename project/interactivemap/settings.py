@@ -11,12 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
-import json
-import re
-
-from six.moves.urllib import request
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.backends import default_backend
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -44,6 +39,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.gis",
+    "django.contrib.postgres",
     "django.contrib.staticfiles",
     "rest_framework",
     "rest_framework.authtoken",
@@ -57,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.budget.QueryBudgetMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -110,6 +107,49 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# The file backends are only shared by the processes that see the same directory. The
+# web and worker services of docker-compose mount the same volume for them (and for
+# TILE_CACHE_DIR), point the LOCATIONs at shared storage or use a network cache such
+# as memcached when running them on separate hosts.
+# Once a cache holds more entries, a third of them is dropped at random. The file
+# backend also lists its directory on every set past that point, so keep it well
+# above the number of epochs and responses that are cached.
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 100000))
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+        ),
+        "LOCATION": os.environ.get(
+            "CACHE_LOCATION", os.path.join(tempfile.gettempdir(), "chronoscio-cache")
+        ),
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": CACHE_MAX_ENTRIES},
+    },
+    # Serialized API responses, see api/response_cache.py. locmem is only safe
+    # with a single worker process, as invalidations are not shared otherwise.
+    "responses": {
+        "BACKEND": os.environ.get(
+            "RESPONSE_CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": os.environ.get(
+            "RESPONSE_CACHE_LOCATION",
+            os.path.join(tempfile.gettempdir(), "chronoscio-responses"),
+        ),
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": CACHE_MAX_ENTRIES},
+    },
+}
+
+# Size in degrees of the grid bounding boxes are widened to, so that nearby map views
+# share cached responses. None keeps them as requested.
+BBOX_GRID_SIZE = 0.25
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -151,31 +191,71 @@ REST_FRAMEWORK = {
         "rest_framework_jwt.authentication.JSONWebTokenAuthentication",
     ),
     "DEFAULT_FILTER_BACKENDS": ("django_filters.rest_framework.DjangoFilterBackend",),
+    "DEFAULT_PAGINATION_CLASS": "api.pagination.KeysetPagination",
+    "PAGE_SIZE": 100,
 }
 
+# Fail read requests going over the query budget of their view instead of logging them
+QUERY_BUDGET_STRICT = os.environ.get("QUERY_BUDGET_STRICT", "") == "1"
+
+# Default and largest number of results of /api/politicalentities/search/
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+
+# Deepest traversal of /api/politicalentities/<url_id>/relations/
+RELATIONS_MAX_DEPTH = 10
+
+# Largest ?page_size= clients can ask for
+API_MAX_PAGE_SIZE = 1000
+
+# Size in degrees of the grid territory coordinates are snapped to when they are
+# saved (and FeatureCollection parts before they are merged), unset keeps them as
+# they are. 0.000001 is about 10cm at the equator.
+GEOMETRY_GRID_SIZE = float(os.environ.get("GEOMETRY_GRID_SIZE", 0)) or None
+
+# Zoom levels for which simplified territory geometries are precomputed
+TERRITORY_ZOOM_LEVELS = (2, 4, 6, 8, 10)
+
+# Directory holding the rendered vector tiles, and the deepest zoom they are served at
+TILE_CACHE_DIR = os.environ.get(
+    "TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chronoscio-tiles")
+)
+TILE_MAX_ZOOM = 16
+
+# Seconds territory snapshots and tiles are cached for. They are invalidated when
+# territories change, this bounds how long one computed during a change is kept.
+SNAPSHOT_CACHE_TIMEOUT = 60 * 60 * 24
+TILE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Rows fetched per round trip when streaming territory exports
+EXPORT_CHUNK_SIZE = 500
+
+# Number of times a job left behind by a dead worker is tried before it fails
+JOB_MAX_ATTEMPTS = 3
+
+# Rows inserted per statement by the bulk territory endpoint
+BULK_BATCH_SIZE = 1000
+
+# Processes reading the shapefiles of an uploaded archive, 0 reads them in the request
+SHAPEFILE_WORKERS = int(os.environ.get("SHAPEFILE_WORKERS", 0))
+
 CORS_ORIGIN_WHITELIST = ("localhost:3000", "interactivemap-frontend-*.now.sh")
 
 AUTH0_DOMAIN = os.environ.get("AUTH0_DOMAIN", "chronoscio.auth0.com")
 API_IDENTIFIER = os.environ.get("API_IDENTIFIER", "https://chronoscio.org/")
 AUTH0_CLIENT_ID = os.environ.get("AUTH0_CLIENT_ID", "")
 AUTH0_CLIENT_SECRET = os.environ.get("AUTH0_CLIENT_SECRET", "")
-PUBLIC_KEY = None
-JWT_ISSUER = None
-
-if AUTH0_DOMAIN:
-    jsonurl = request.urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
-    # Add a line-break every 64 chars
-    # https://stackoverflow.com/questions/2657693/insert-a-newline-character-every-64-characters-using-python
-    body = re.sub("(.{64})", "\\1\n", jwks["keys"][0]["x5c"][0], 0, re.DOTALL)
-    cert = "-----BEGIN CERTIFICATE-----\n" + body + "\n-----END CERTIFICATE-----"
-    certificate = load_pem_x509_certificate(cert.encode("utf-8"), default_backend())
-    PUBLIC_KEY = certificate.public_key()
-    JWT_ISSUER = "https://" + AUTH0_DOMAIN + "/"
+# Signing keys are fetched from the Auth0 tenant on first use, see api/jwks.py.
+# Set one of these to read them from a local JWKS or PEM file instead.
+AUTH0_JWKS_FILE = os.environ.get("AUTH0_JWKS_FILE", "")
+AUTH0_PUBLIC_KEY_FILE = os.environ.get("AUTH0_PUBLIC_KEY_FILE", "")
+# Seconds signing keys are cached for when Auth0 does not send a max-age
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", 3600))
+JWT_ISSUER = "https://" + AUTH0_DOMAIN + "/" if AUTH0_DOMAIN else None
 
 JWT_AUTH = {
     "JWT_PAYLOAD_GET_USERNAME_HANDLER": "api.user.jwt_get_username_from_payload_handler",
-    "JWT_PUBLIC_KEY": PUBLIC_KEY,
+    "JWT_DECODE_HANDLER": "api.user.jwt_decode_handler",
     "JWT_ALGORITHM": "RS256",
     "JWT_AUDIENCE": API_IDENTIFIER,
     "JWT_ISSUER": JWT_ISSUER,